@@ -0,0 +1,74 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+"""
+Data augmentation views: a learned sequence is stored once, and learned through several views.
+A view maps an input object to a transformed copy. It is applied on the fly, when the viewpoints of the sequence
+are computed and when an address of the sequence is realized (see Variable_order_Markov.get_input_object),
+so augmented sequences cost their int-coded viewpoints only. None is the identity view.
+The views below transform the pitch of notes (see midi_stuff.mini_muse.Note).
+"""
+
+
+def fold_pitch(pitch):
+    # octave-folds a pitch into the MIDI range
+    while pitch < 0:
+        pitch += 12
+    while pitch > 127:
+        pitch -= 12
+    return pitch
+
+
+class PitchView:
+    # maps the pitch of notes by map_pitch, defined by the subclasses. Pitches out of the MIDI range are folded.
+    # Views are sent to the worker processes of model_selection, so they must stay picklable (no lambdas)
+    def __call__(self, note):
+        return note.transpose(fold_pitch(self.map_pitch(note.pitch)) - note.pitch)
+
+
+class Transposition(PitchView):
+    def __init__(self, semitones):
+        self.semitones = semitones
+
+    def map_pitch(self, pitch):
+        return pitch + self.semitones
+
+    def __repr__(self):
+        return f"Transposition({self.semitones})"
+
+
+class Inversion(PitchView):
+    # mirrors pitches around an axis pitch
+    def __init__(self, axis=60):
+        self.axis = axis
+
+    def map_pitch(self, pitch):
+        return 2 * self.axis - pitch
+
+    def __repr__(self):
+        return f"Inversion({self.axis})"
+
+
+class NegativeHarmony(PitchView):
+    # mirrors pitches around the axis between the minor and major thirds of the tonic,
+    # so that the tonic and the fifth are exchanged, as well as major and minor chords
+    def __init__(self, tonic=60):
+        self.tonic = tonic
+
+    def map_pitch(self, pitch):
+        return 2 * self.tonic + 7 - pitch
+
+    def __repr__(self):
+        return f"NegativeHarmony({self.tonic})"
+
+
+def transpositions(low=-6, high=6):
+    # the views of the transpositions from low to high (excluded) semitones. The original is the identity view
+    return [None if t == 0 else Transposition(t) for t in range(low, high)]
+
+
+augmentations = {"inversion": Inversion, "negative harmony": NegativeHarmony}
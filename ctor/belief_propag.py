@@ -1,6 +1,8 @@
 import numpy as np
 from collections import namedtuple
 
+from ctor.sparse_matrix import CSRMatrix
+
 
 class NoSolutionError(Exception):
     def __init__(self, message):
@@ -51,42 +53,27 @@ def is_joint_prob(labeled_array):
     return np.all(np.isclose(np.sum(labeled_array.array), 1.0))
 
 
-def tile_to_shape_along_axis(arr, target_shape, target_axis):
-    # get a list of all axes
-    raw_axes = list(range(len(target_shape)))
-    tile_dimensions = [target_shape[a] for a in raw_axes if a != target_axis]
-    if len(arr.shape) == 0:
-        # If given a scalar, also tile it in the target dimension (so it's a bunch of 1s)
-        tile_dimensions += [target_shape[target_axis]]
-    elif len(arr.shape) == 1:
-        # If given an array, it should be the same shape as the target axis
-        assert arr.shape[0] == target_shape[target_axis]
-        tile_dimensions += [1]
-    else:
-        raise NotImplementedError()
-    tiled = np.tile(arr, tile_dimensions)
-
-    # Tiling only adds prefix axes, so rotate this one back into place
-    shifted_axes = raw_axes[:target_axis] + [raw_axes[-1]] + raw_axes[target_axis:-1]
-    transposed = np.transpose(tiled, shifted_axes)
-
-    # Double-check this code tiled it to the correct shape
-    assert transposed.shape == target_shape
-    return transposed
-
+def normalize_message(message):
+    # messages are defined up to a constant: normalizing them avoids underflows on long chains, notably in float32
+    total = np.sum(message)
+    if total > 0:
+        return message / total
+    return message
 
-def tile_to_other_dist_along_axis_name(tiling_labeled_array, target_array):
-    assert len(tiling_labeled_array.axes_labels) == 1
-    target_axis_label = tiling_labeled_array.axes_labels[0]
 
-    return LabeledArray(
-        tile_to_shape_along_axis(
-            tiling_labeled_array.array,
-            target_array.array.shape,
-            name_to_axis_mapping(target_array)[target_axis_label],
-        ),
-        axes_labels=target_array.axes_labels,
-    )
+def rescaled_product(messages):
+    # product of messages, each divided by its maximum so that the product does not underflow when many are
+    # multiplied. Accumulated in one buffer, rather than stacking the messages. 1 if there are no messages
+    product = None
+    for message in messages:
+        maximum = np.max(message)
+        if product is None:
+            product = message / maximum if maximum > 0 else np.array(message)
+            continue
+        product *= message
+        if maximum > 0:
+            product /= maximum
+    return 1.0 if product is None else product
 
 
 class Node(object):
@@ -194,6 +181,15 @@ class PGM(object):
     def __init__(self, factors, variables):
         self._factors = factors
         self._variables = variables
+        # for O(1) lookups by name
+        self._factors_by_name = {factor.name: factor for factor in factors}
+        # variable name -> data of its unary factor before evidence was set (see set_evidence)
+        self._evidence = {}
+        # for chains built by chain_pgm: the variables and unary factors by position, and the pairwise factors
+        # p(x{i + 2}|x{i + 1}) by position i
+        self._chain_variables = None
+        self._unary_factors = None
+        self._pairwise_factors = None
 
     @classmethod
     def from_string(cls, model_string):
@@ -231,21 +227,112 @@ class PGM(object):
         return self._variables[var_name]
 
     def factor_from_name(self, fac_name):
-        for f in self._factors:
-            if f.name == fac_name:
-                return f
-        print(f"factor not found: {fac_name}")
-        return None
+        factor = self._factors_by_name.get(fac_name)
+        if factor is None:
+            print(f"factor not found: {fac_name}")
+        return factor
+
+    def variable_from_index(self, position):
+        # the variable at a position (from 0) of a chain
+        return self._chain_variables[position]
+
+    def set_chain_data(self, prior, matrix):
+        """Sets the data of a chain: prior is the unary factor of all variables, and matrix the pairwise factor,
+        with matrix[b, a] = p(x{i + 1} = b | x{i} = a), dense or CSRMatrix. Also clears the values set before"""
+        if matrix.shape != (len(prior), len(prior)):
+            raise ValueError("pairwise factor is {}, expected {}".format(matrix.shape, (len(prior), len(prior))))
+        self._evidence = {}
+        for variable, factor in zip(self._chain_variables, self._unary_factors):
+            factor.data = LabeledArray(prior, [variable.name])
+        for factor in self._pairwise_factors:
+            factor.data = LabeledArray(matrix, [factor.neighbors[0].name, factor.neighbors[1].name])
 
     def print_marginals(self):
-        for var in self._variables.values():
-            print(f"marginal: {var.name}: {Messages().marginal(var)}")
+        for name, marginal in Messages().marginals(self).items():
+            print(f"marginal: {name}: {marginal}")
 
     def set_value(self, var_name, value_idx):
         factor = self.factor_from_name('p(' + var_name + ')')
-        data = np.zeros(len(factor.data.array))
+        data = np.zeros_like(factor.data.array)
+        data[value_idx] = 1
+        factor.data = LabeledArray(data, [var_name])
+
+    def set_evidence(self, var_name, value_idx):
+        """Fixes a variable to a value, as set_value, keeping the data of its unary factor so that the evidence
+        can be retracted. Returns the unary factor, whose outgoing messages are stale (see Messages.set_evidence)"""
+        factor = self.factor_from_name('p(' + var_name + ')')
+        if var_name not in self._evidence:
+            self._evidence[var_name] = factor.data
+        data = np.zeros_like(self._evidence[var_name].array)
         data[value_idx] = 1
         factor.data = LabeledArray(data, [var_name])
+        return factor
+
+    def retract_evidence(self, var_name):
+        # restores the unary factor of a variable fixed by set_evidence, and returns it. None if it was not fixed
+        data = self._evidence.pop(var_name, None)
+        if data is None:
+            return None
+        factor = self.factor_from_name('p(' + var_name + ')')
+        factor.data = data
+        return factor
+
+
+def chain_pgm(length):
+    """The PGM of p(x1)...p(x{length})p(x2|x1)...p(x{length}|x{length - 1}), built from indices instead of
+    parsing the model string, with the same names and neighbors. Its data is set by set_chain_data"""
+    variables = [Variable("x" + str(i + 1)) for i in range(length)]
+    unary_factors = []
+    for variable in variables:
+        factor = Factor("p(" + variable.name + ")")
+        factor.add_neighbor(variable)
+        variable.add_neighbor(factor)
+        unary_factors.append(factor)
+    pairwise_factors = []
+    for previous, variable in zip(variables, variables[1:]):
+        factor = Factor("p(" + variable.name + "|" + previous.name + ")")
+        for neighbor in (variable, previous):
+            factor.add_neighbor(neighbor)
+            neighbor.add_neighbor(factor)
+        pairwise_factors.append(factor)
+    pgm = PGM(unary_factors + pairwise_factors, {variable.name: variable for variable in variables})
+    pgm._chain_variables = variables
+    pgm._unary_factors = unary_factors
+    pgm._pairwise_factors = pairwise_factors
+    return pgm
+
+
+def tree_schedule(pgm, root=None):
+    """The messages (sender, receiver) of a tree-shaped pgm, in an order where each message only depends on
+    messages before it: from the leaves inward to a root variable, then back outward. Each connected component
+    is rooted at its first variable. With a root, only the messages toward the root, in its component.
+    Computed by iterative depth first traversals, so there is no recursion limit on the size of the graph"""
+    roots = list(pgm._variables.values()) if root is None else [root]
+    visited = set()
+    inward = []
+    outward = []
+    for start in roots:
+        if id(start) in visited:
+            continue
+        visited.add(id(start))
+        # (node, parent) pairs in depth first preorder: a node comes before its descendants
+        order = []
+        stack = [(start, None)]
+        while stack:
+            node, parent = stack.pop()
+            order.append((node, parent))
+            for neighbor in node.neighbors:
+                if neighbor is parent:
+                    continue
+                if id(neighbor) in visited:
+                    raise ValueError("the factor graph is not a tree")
+                visited.add(id(neighbor))
+                stack.append((neighbor, node))
+        inward.extend((node, parent) for node, parent in reversed(order) if parent is not None)
+        outward.extend((parent, node) for node, parent in order if parent is not None)
+    if root is not None:
+        return inward
+    return inward + outward
 
 
 class Messages(object):
@@ -261,33 +348,51 @@ class Messages(object):
         ]
 
         # If there are no incoming messages, this is 1
-        return np.prod(incoming_messages, axis=0)
+        return normalize_message(rescaled_product(incoming_messages))
 
     def _factor_to_variable_messages(self, factor, variable):
         # print (f"_factor_to_variable_message: {factor} to {variable}")
-        # Compute the product
-        factor_dist = np.copy(factor.data.array)
+        if isinstance(factor.data.array, CSRMatrix):
+            return self._sparse_factor_to_variable_messages(factor, variable)
+        # Contracts the factor with the incoming message of each other variable, one axis at a time:
+        # tensordot multiplies and sums over the axis without expanding the message to the shape of the factor,
+        # so the only allocations are the (smaller) partial contractions
+        factor_dist = factor.data.array
+        axes_labels = list(factor.data.axes_labels)
         for neighbor_variable in factor.neighbors:
             if neighbor_variable.name == variable.name:
                 continue
             incoming_message = self.variable_to_factor_messages(
                 neighbor_variable, factor
             )
-            factor_dist *= tile_to_other_dist_along_axis_name(
-                LabeledArray(incoming_message, [neighbor_variable.name]), factor.data
-            ).array
-        # Sum over the axes that aren't `variable`
-        other_axes = other_axes_from_labeled_axes(factor.data, variable.name)
-        return np.squeeze(np.sum(factor_dist, axis=other_axes))
+            axis = axes_labels.index(neighbor_variable.name)
+            if np.ndim(incoming_message) == 0:
+                # no other incoming message, i.e. all ones
+                factor_dist = np.sum(factor_dist, axis=axis)
+            else:
+                factor_dist = np.tensordot(
+                    factor_dist, incoming_message.astype(factor_dist.dtype, copy=False), axes=([axis], [0])
+                )
+            del axes_labels[axis]
+        return normalize_message(factor_dist)
+
+    def _sparse_factor_to_variable_messages(self, factor, variable):
+        # sparse factors are matrices over two variables, so the product with the incoming message
+        # followed by the sum over the other variable is a sparse matrix-vector product
+        matrix = factor.data.array
+        if factor.data.axes_labels[0] != variable.name:
+            matrix = matrix.transpose()
+        neighbor_variable = [v for v in factor.neighbors if v.name != variable.name][0]
+        incoming_message = self.variable_to_factor_messages(neighbor_variable, factor)
+        if np.ndim(incoming_message) == 0:
+            incoming_message = np.full(matrix.shape[1], incoming_message, dtype=matrix.dtype)
+        return normalize_message(matrix.dot(incoming_message))
 
     def marginal(self, variable):
         # p(variable) is proportional to the product of incoming messages to variable.
-        unnorm_p = np.prod(
-            [
-                self.factor_to_variable_message(neighbor_factor, variable)
-                for neighbor_factor in variable.neighbors
-            ],
-            axis=0,
+        unnorm_p = rescaled_product(
+            self.factor_to_variable_message(neighbor_factor, variable)
+            for neighbor_factor in variable.neighbors
         )
         # At this point, we can normalize this distribution
         somme = np.sum(unnorm_p)
@@ -295,6 +400,59 @@ class Messages(object):
             raise NoSolutionError("marginals are nan")
         return unnorm_p / somme
 
+    def compute(self, schedule):
+        # computes the messages of a schedule (see tree_schedule): as each message finds the messages it depends
+        # on already computed, there is no recursion
+        for sender, receiver in schedule:
+            if isinstance(sender, Variable):
+                self.variable_to_factor_messages(sender, receiver)
+            else:
+                self.factor_to_variable_message(sender, receiver)
+
+    def marginals(self, pgm):
+        # {variable name: marginal} of a tree-shaped pgm, from one sweep inward and outward, each message once
+        self.compute(tree_schedule(pgm))
+        return {name: self.marginal(variable) for name, variable in pgm._variables.items()}
+
+    def rooted_marginal(self, variable):
+        # same as marginal(variable), computing without recursion the messages toward variable not computed yet
+        self.compute(self.missing_messages(variable))
+        return self.marginal(variable)
+
+    def missing_messages(self, root):
+        # the messages toward root in a tree that are not computed, in an order where each message only depends
+        # on messages before it or already computed. Computed messages are not explored: their dependencies
+        # are computed too
+        order = []
+        stack = [(neighbor, root) for neighbor in root.neighbors]
+        while stack:
+            sender, receiver = stack.pop()
+            if (sender.name, receiver.name) in self.messages:
+                continue
+            order.append((sender, receiver))
+            stack.extend((neighbor, sender) for neighbor in sender.neighbors if neighbor is not receiver)
+        order.reverse()
+        return order
+
+    def invalidate(self, factor):
+        # removes the messages that depend on the data of factor in a tree, i.e. the messages flowing away from it.
+        # As a message is computed after the messages it depends on, the removal stops at messages not computed
+        stack = [(factor, neighbor) for neighbor in factor.neighbors]
+        while stack:
+            sender, receiver = stack.pop()
+            if self.messages.pop((sender.name, receiver.name), None) is None:
+                continue
+            stack.extend((receiver, neighbor) for neighbor in receiver.neighbors if neighbor is not sender)
+
+    def set_evidence(self, pgm, var_name, value_idx):
+        # fixes a variable (see PGM.set_evidence), keeping the messages that do not depend on it
+        self.invalidate(pgm.set_evidence(var_name, value_idx))
+
+    def retract_evidence(self, pgm, var_name):
+        factor = pgm.retract_evidence(var_name)
+        if factor is not None:
+            self.invalidate(factor)
+
     def variable_to_factor_messages(self, variable, factor):
         # print (f"variable_to_factor_messages: {variable} to {factor}")
         message_name = (variable.name, factor.name)
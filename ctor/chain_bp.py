@@ -0,0 +1,205 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import numpy as np
+
+from ctor.belief_propag import NoSolutionError, normalize_message
+from ctor.sparse_matrix import CSRMatrix
+
+
+class ChainBP:
+    """
+    Exact inference on the chain built by Variable_order_Markov.build_bp_graph: variables x_0 ... x_{length - 1}
+    with V values, a unary factor per variable (the prior, or a one-hot vector for a fixed value)
+    and the same pairwise factor matrix[a, b] = p(x_{i + 1} = b | x_i = a) between consecutive variables.
+    One backward pass computes the messages beta_i(a), proportional to u_i(a) * sum_b matrix[a, b] * beta_{i + 1}(b),
+    i.e. to the probability that the fixed values after i can be reached from x_i = a, with L matrix-vector products.
+    Sampling forward then conditions exactly on the previous value: p(x_i | x_{i - 1} = c) is proportional to
+    matrix[c, :] * beta_i, so a sequence costs O(L * V^2), or O(L * nnz) with a sparse matrix,
+    instead of recomputing all the messages of the graph at each step.
+    Messages are normalized, and stored in an L x V array.
+    With log_domain, for chains of thousands of steps, messages are log probabilities in float64 shifted to a
+    maximum of 0, and products are log-sum-exps: values that can reach the fixed values are never rounded to 0,
+    however unlikely, whereas normalized messages may underflow (notably in float32) and raise spurious
+    NoSolutionError.
+    """
+
+    # rows of a dense matrix processed at once by log-sum-exps, bounding the temporary arrays
+    LOG_BLOCK_SIZE = 256
+
+    def __init__(self, matrix, length, prior, log_domain=False):
+        # matrix is row-normalized, dense or CSRMatrix. prior is the unary factor of variables with no fixed value
+        self.matrix = matrix
+        self.length = length
+        self.prior = prior
+        self.log_domain = log_domain
+        # position -> fixed value
+        self.values = {}
+        self.messages = None
+        self.log_matrix = None
+        if log_domain:
+            with np.errstate(divide="ignore"):
+                if isinstance(matrix, CSRMatrix):
+                    self.log_matrix = CSRMatrix(matrix.indptr, matrix.indices,
+                                                np.log(matrix.data.astype(np.float64)), matrix.shape)
+                else:
+                    self.log_matrix = np.log(matrix.astype(np.float64))
+
+    def nbytes(self):
+        # the memory of the messages, computed or not, and of the log matrix, which is not shared with the model
+        itemsize = np.dtype(np.float64 if self.log_domain else self.prior.dtype).itemsize
+        size = self.length * len(self.prior) * itemsize
+        if isinstance(self.log_matrix, CSRMatrix):
+            size += self.log_matrix.data.nbytes
+        elif self.log_matrix is not None:
+            size += self.log_matrix.nbytes
+        return size
+
+    def set_value(self, position, value):
+        self.values[position] = value
+        self.messages = None
+
+    def unary(self, position):
+        value = self.values.get(position)
+        if value is None:
+            return self.prior
+        data = np.zeros_like(self.prior)
+        data[value] = 1
+        return data
+
+    def log_unary(self, position):
+        value = self.values.get(position)
+        if value is None:
+            with np.errstate(divide="ignore"):
+                return np.log(self.prior.astype(np.float64))
+        data = np.full(len(self.prior), -np.inf)
+        data[value] = 0
+        return data
+
+    @staticmethod
+    def shift(log_message):
+        # log messages are defined up to a constant, shifted so that their maximum is 0
+        maximum = np.max(log_message)
+        if maximum == -np.inf:
+            return log_message
+        return log_message - maximum
+
+    def log_dot(self, log_vector):
+        # log(matrix @ exp(log_vector)), each row shifted by its own maximum
+        if isinstance(self.log_matrix, CSRMatrix):
+            matrix = self.log_matrix
+            result = np.full(matrix.shape[0], -np.inf)
+            if len(matrix._row_starts) == 0:
+                return result
+            values = matrix.data + log_vector[matrix.indices]
+            maxima = np.maximum.reduceat(values, matrix._row_starts)
+            # rows that cannot reach anything stay at -inf
+            maxima[maxima == -np.inf] = 0
+            row_maxima = np.repeat(maxima, np.diff(matrix.indptr)[matrix._nonempty_rows])
+            sums = np.add.reduceat(np.exp(values - row_maxima), matrix._row_starts)
+            with np.errstate(divide="ignore"):
+                result[matrix._nonempty_rows] = maxima + np.log(sums)
+            return result
+        result = np.empty(len(self.log_matrix))
+        for start in range(0, len(self.log_matrix), self.LOG_BLOCK_SIZE):
+            values = self.log_matrix[start:start + self.LOG_BLOCK_SIZE] + log_vector
+            maxima = np.max(values, axis=1)
+            maxima[maxima == -np.inf] = 0
+            with np.errstate(divide="ignore"):
+                result[start:start + self.LOG_BLOCK_SIZE] = maxima + np.log(
+                    np.sum(np.exp(values - maxima[:, None]), axis=1))
+        return result
+
+    def log_backward(self):
+        messages = np.empty((self.length, len(self.prior)))
+        messages[-1] = self.shift(self.log_unary(self.length - 1))
+        for position in range(self.length - 2, -1, -1):
+            messages[position] = self.shift(self.log_unary(position) + self.log_dot(messages[position + 1]))
+        self.messages = messages
+
+    def backward(self):
+        if self.log_domain:
+            self.log_backward()
+            return
+        messages = np.empty((self.length, len(self.prior)), dtype=self.prior.dtype)
+        messages[-1] = normalize_message(self.unary(self.length - 1))
+        for position in range(self.length - 2, -1, -1):
+            messages[position] = normalize_message(self.unary(position) * self.matrix.dot(messages[position + 1]))
+        self.messages = messages
+
+    def get_messages(self):
+        # computed once, until the next set_value
+        if self.messages is None:
+            self.backward()
+        return self.messages
+
+    def row(self, value):
+        if isinstance(self.matrix, CSRMatrix):
+            return self.matrix.row(value)
+        return self.matrix[value]
+
+    def log_row(self, value):
+        if isinstance(self.log_matrix, CSRMatrix):
+            result = np.full(self.log_matrix.shape[1], -np.inf)
+            start, end = self.log_matrix.indptr[value], self.log_matrix.indptr[value + 1]
+            result[self.log_matrix.indices[start:end]] = self.log_matrix.data[start:end]
+            return result
+        return self.log_matrix[value]
+
+    def rows(self, values):
+        if isinstance(self.matrix, CSRMatrix):
+            return self.matrix.rows(values)
+        return self.matrix[values]
+
+    def log_rows(self, values):
+        if isinstance(self.log_matrix, CSRMatrix):
+            return self.log_matrix.rows(values, -np.inf)
+        return self.log_matrix[values]
+
+    @staticmethod
+    def exp_normalized(log_p):
+        maximum = np.max(log_p)
+        if maximum == -np.inf:
+            raise NoSolutionError("marginals are nan")
+        p = np.exp(log_p - maximum)
+        # values that can reach the fixed values must keep a non zero probability, as the sampler masks the others
+        p[(p == 0) & (log_p > -np.inf)] = np.finfo(p.dtype).tiny
+        return p / np.sum(p)
+
+    @staticmethod
+    def normalized(unnorm_p):
+        total = np.sum(unnorm_p)
+        if total == 0:
+            raise NoSolutionError("marginals are nan")
+        return unnorm_p / total
+
+    def first_marginal(self):
+        # p(x_0) given the fixed values
+        if self.log_domain:
+            return self.exp_normalized(self.get_messages()[0])
+        return self.normalized(self.get_messages()[0])
+
+    def marginal(self, position, previous):
+        # p(x_position | x_{position - 1} = previous) given the fixed values
+        if self.log_domain:
+            return self.exp_normalized(self.log_row(previous) + self.get_messages()[position])
+        return self.normalized(self.row(previous) * self.get_messages()[position])
+
+    def marginals(self, position, previous):
+        # marginal for each value of an array of previous values, as the rows of a (len(previous), V) array.
+        # Rows of previous values that cannot reach the fixed values are all zeros
+        if self.log_domain:
+            log_p = self.log_rows(previous) + self.get_messages()[position]
+            maxima = np.max(log_p, axis=1, keepdims=True)
+            maxima[maxima == -np.inf] = 0
+            p = np.exp(log_p - maxima)
+            # as in exp_normalized
+            p[(p == 0) & (log_p > -np.inf)] = np.finfo(p.dtype).tiny
+        else:
+            p = self.rows(previous) * self.get_messages()[position]
+        totals = np.sum(p, axis=1, keepdims=True)
+        return np.divide(p, totals, out=np.zeros_like(p), where=totals > 0)
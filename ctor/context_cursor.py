@@ -0,0 +1,70 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+
+class ContextCursor:
+    """
+    Generation state of a Variable_order_Markov: the sequence of vp ids generated so far,
+    with the length of its longest suffix that is a known context (of order <= kmax).
+    Appending an id updates the longest context in amortized O(1), as it can grow by at most 1 at each step:
+    with a suffix automaton, by following transitions and suffix links; with per order dicts,
+    by testing contexts from the previous length + 1 downwards, so unknown long contexts are not hashed at each step;
+    with shards, by looking up these contexts in a single batch.
+    Contexts are suffix-closed (the suffixes of a known context are known), so the shorter contexts
+    used by the singleton-skip backoff are the suffixes of the longest one, and are looked up only when needed.
+    """
+
+    def __init__(self, model, id_sequence=(), kmax=None):
+        self.model = model
+        self.kmax = model.max_order(kmax)
+        self.ids = []
+        # length of the longest known context, and its suffix automaton state if any
+        self.length = 0
+        self.state = 0
+        # with shards, the tables of the known contexts, looked up at each append
+        self.tables = []
+        for vp_id in id_sequence:
+            self.append(vp_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, vp_id):
+        self.ids.append(vp_id)
+        automaton = self.model.suffix_automaton
+        if automaton is not None:
+            self.state, self.length = automaton.step(self.state, self.length, vp_id)
+            return
+        if self.model.shards is not None:
+            # a single batch for all the candidate contexts
+            self.tables = self.model.fetch_context_tables(self.ids, min(self.length + 1, self.kmax, len(self.ids)))
+            self.length = self.tables[0][0] if self.tables else 0
+            return
+        contexts = self.model.prefixes_to_continuations
+        k = min(self.length + 1, self.kmax, len(self.ids))
+        while k > 0 and tuple(self.ids[-k:]) not in contexts[k - 1]:
+            k -= 1
+        self.length = k
+
+    def extend(self, id_sequence):
+        for vp_id in id_sequence:
+            self.append(vp_id)
+
+    def context_tables(self):
+        # yields (k, ContinuationTable) for the known contexts, from the longest to the shortest
+        automaton = self.model.suffix_automaton
+        if automaton is not None:
+            yield from automaton.tables_from(self.state, self.length, self.kmax)
+            return
+        if self.model.shards is not None:
+            yield from self.tables
+            return
+        contexts = self.model.prefixes_to_continuations
+        for k in range(self.length, 0, -1):
+            table = contexts[k - 1].get(tuple(self.ids[-k:]))
+            if table is not None:
+                yield k, table
@@ -0,0 +1,154 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import bisect
+import random
+from itertools import accumulate, compress
+
+import numpy as np
+
+
+def choose(ids, weights, cumulative, exclude=None):
+    # draws an id with probability proportional to its weight, given the cumulative weights,
+    # with a single random() and a binary search, as random.choices does
+    if exclude is not None:
+        kept = [vp_id != exclude for vp_id in ids]
+        ids = list(compress(ids, kept))
+        cumulative = list(accumulate(compress(weights, kept)))
+    return ids[bisect.bisect(cumulative, random.random() * cumulative[-1], 0, len(ids) - 1)]
+
+
+class ContinuationTable:
+    """
+    The continuations of a context: each distinct continuation vp id with its number of occurrences.
+    The total count is maintained at each update, so that singleton tests and sampling
+    depend on the number of distinct continuations, not on the corpus frequency of the context.
+    With a RecencyDecay, counts are stored with the time of their last update (per entry, and for the total),
+    and decayed when they are read or updated.
+    For sampling, continuations and their cumulative weights are cached until the next update.
+    """
+
+    __slots__ = ("counts", "total", "stamps", "total_stamp", "_ids", "_id_array", "_weights", "_cumulative",
+                 "_rate")
+
+    def __init__(self, counts=None):
+        # vp id -> count
+        self.counts = {} if counts is None else counts
+        self.total = sum(self.counts.values())
+        # vp id -> time of the last update, only with decay. Missing entries were updated at time 0
+        self.stamps = None
+        self.total_stamp = 0
+        # sampling arrays, and the decay rate they were computed with
+        self._ids = None
+        self._id_array = None
+        self._weights = None
+        self._cumulative = None
+        self._rate = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, vp_id):
+        return vp_id in self.counts
+
+    @property
+    def distinct(self):
+        # the number of different continuations
+        return len(self.counts)
+
+    def add(self, vp_id, count=1, decay=None):
+        self._ids = None
+        if decay is None:
+            self.counts[vp_id] = self.counts.get(vp_id, 0) + count
+            self.total += count
+            return
+        if self.stamps is None:
+            self.stamps = {}
+        self.counts[vp_id] = self.weight(vp_id, decay) + count
+        self.stamps[vp_id] = decay.time
+        self.total = self.get_total(decay) + count
+        self.total_stamp = decay.time
+
+    def remove(self, vp_id, count=1, decay=None):
+        # count is the current weight of the removed occurrences
+        self._ids = None
+        if vp_id not in self.counts:
+            # the occurrence was pruned (see memory_usage)
+            return
+        remaining = self.weight(vp_id, decay) - count
+        # a small tolerance for decayed counts
+        if remaining > 1e-9 * count:
+            self.counts[vp_id] = remaining
+            if decay is not None:
+                self.stamps[vp_id] = decay.time
+        else:
+            del self.counts[vp_id]
+            if self.stamps is not None:
+                self.stamps.pop(vp_id, None)
+        self.total = self.get_total(decay) - count
+        if decay is not None:
+            self.total_stamp = decay.time
+
+    def weight(self, vp_id, decay=None):
+        count = self.counts.get(vp_id, 0)
+        if decay is None:
+            return count
+        return count * decay.factor(self.stamps.get(vp_id, 0) if self.stamps else 0)
+
+    def weights(self, ids, decay=None):
+        # the weights of ids, up to a constant factor: with decay, they are relative to the most recent update,
+        # so that they do not underflow when the table has not been updated for a long time
+        if decay is None or not self.stamps:
+            return [self.counts.get(vp_id, 0) for vp_id in ids]
+        stamps = [self.stamps.get(vp_id, 0) for vp_id in ids]
+        latest = max(stamps)
+        return [self.counts.get(vp_id, 0) * decay.rate ** (latest - stamp) for vp_id, stamp in zip(ids, stamps)]
+
+    def get_total(self, decay=None):
+        if decay is None:
+            return self.total
+        return self.total * decay.factor(self.total_stamp)
+
+    def ids(self):
+        return list(self.counts)
+
+    def first(self):
+        # the continuation of a singleton table
+        return next(iter(self.counts))
+
+    def count(self, vp_id):
+        return self.counts.get(vp_id, 0)
+
+    def arrays(self, decay=None):
+        # (ids, weights, cumulative weights) of the continuations, cached until the next update
+        rate = None if decay is None else decay.rate
+        if self._ids is None or self._rate != rate:
+            self._ids = list(self.counts)
+            self._id_array = np.array(self._ids, dtype=np.int64)
+            self._weights = self.weights(self._ids, decay)
+            self._cumulative = list(accumulate(self._weights))
+            self._rate = rate
+        return self._ids, self._weights, self._cumulative
+
+    def masked(self, probs, decay=None):
+        # (ids, weights, cumulative weights) of the continuations with a non zero probability in probs,
+        # indexed by vp id
+        ids, weights, cumulative = self.arrays(decay)
+        if len(ids) == 1:
+            return (ids, weights, cumulative) if probs[ids[0]] > 0 else ([], [], [])
+        # gathers the probabilities of the continuations in one numpy operation
+        mask = probs[self._id_array] > 0
+        if np.count_nonzero(mask) == len(ids):
+            return ids, weights, cumulative
+        weights = list(compress(weights, mask))
+        return list(compress(ids, mask)), weights, list(accumulate(weights))
+
+    def sample(self, exclude=None, decay=None):
+        # draws a continuation with probability proportional to its count, possibly excluding one
+        if exclude is None and len(self.counts) == 1:
+            return self.first()
+        return choose(*self.arrays(decay), exclude)
@@ -13,6 +13,7 @@ import random
 import time
 from difflib import SequenceMatcher
 
+from ctor import augmentation, model_selection
 from ctor.variable_order_markov import Variable_order_Markov
 from midi_stuff.mini_muse import Note
 
@@ -29,7 +30,7 @@ from midi_stuff.mini_muse import Note
 They have a "status" describing how they were played originally, which is preserved at sampling. This enables more creativity for chords.
 - TODO: audio synthesis with Dawdreamer
 - TODO: add database storage of real time performances
-- TODO: data augmentation with inversions, negative harmony, etc.
+- Data augmentation (transpositions, inversions, negative harmony) with views of the learned phrases, stored once
 - TODO: rhythm transfer for data augmentation/control
 - TODO: server with js client, or huggingface solution or github page with python2js
 - TODO: use fine-tuning of transformers
@@ -39,9 +40,11 @@ class Continuator2:
 
     def __init__(self, midi_file: object = None, kmax: int = 5, transposition: bool = False) -> None:
         self.learn_input = True
-        self.vom = Variable_order_Markov(None, self.get_viewpoint, kmax)
+        self.vom = Variable_order_Markov(None, self.get_viewpoint, kmax, dedup_realizations=True)
         self.tempo_msgs = []
         self.transpose = transposition
+        # other augmentation views, applied to each learned phrase (see augmentation)
+        self.augmentations = []
         self.forget_past = False
         self.keep_last_n_melodies = 20
         # for generation from midifiles
@@ -67,9 +70,39 @@ class Continuator2:
     def set_keep_last(self, keep):
         self.keep_last_n_melodies = keep
 
+    def set_decay(self, rate):
+        # soft forgetting: a phrase learned n phrases ago weighs rate ** n. None or 1 for no decay
+        self.vom.set_decay(rate)
+
+    def set_memory_budget(self, max_bytes, policy="frequency"):
+        # keeps the model within about max_bytes by pruning rare high order contexts, see Variable_order_Markov
+        self.vom.set_memory_budget(max_bytes, policy)
+
+    def merge(self, other):
+        # adds the phrases learned by another Continuator2, without relearning them (see Variable_order_Markov.merge)
+        self.vom.merge(other.vom)
+
+    def subtract(self, other):
+        # removes the phrases of another Continuator2 that were merged in this one
+        self.vom.subtract(other.vom)
+
+    def tune_kmax(self, kmax_values=range(1, 9), folds=5, processes=None):
+        """Cross-validated perplexity of the learned phrases for each kmax, with and without transpositions
+        (see model_selection). Returns the perplexities and the best (kmax, transposition) pair"""
+        views_options = {"no transposition": None, "transposition": augmentation.transpositions(-6, 6)}
+        perplexities = model_selection.cross_validate(self.vom.input_sequences, self.get_viewpoint, kmax_values,
+                                                      views_options, folds, processes)
+        if not perplexities:
+            return perplexities, None
+        return perplexities, model_selection.best_parameters(perplexities)
+
     def set_transpose(self, trans):
         self.transpose = trans
 
+    def set_augmentations(self, names):
+        # names of augmentation.augmentations, e.g. ["inversion", "negative harmony"]
+        self.augmentations = [augmentation.augmentations[name]() for name in names]
+
     def get_phrase_titles(self):
         return [f"{i + 1} phrase with {len(phrase)} notes" for i, phrase in enumerate(self.vom.input_sequences)]
 
@@ -98,14 +131,11 @@ class Continuator2:
         all_pitches = [note.pitch for note in note_sequence]
         print(f"number of different pitches in train: {len(Counter(all_pitches))}")
         print(f"min pitch: {min(all_pitches)}, max pitch: {max(all_pitches)}")
-        # learns, possibly in 12 transpositions
-        trange = range(0, 1)
+        # learns, possibly in 12 transpositions, which are views of the phrase computed on the fly
+        views = [None]
         if transposition:
-            trange = range(-6, 6, 1)
-        for t in trange:
-            transposed = self.transpose_notes(note_sequence, t)
-            # learns one more sequence
-            self.vom.learn_sequence(transposed)
+            views = augmentation.transpositions(-6, 6)
+        self.vom.learn_sequence(note_sequence, views=views + self.augmentations)
 
     def learn_files(self, files, transposition=False):
         # suppose at least one file has been learned already
@@ -211,28 +241,31 @@ class Continuator2:
         path = pathlib.Path(path_string)
         return list(path.glob('*.mid')) + list(path.glob('*.midi'))
 
-    def sample_sequence(self, length=50, constraints=None):
+    def sample_sequence(self, length=50, constraints=None, relax=False):
         """
         :param length:
         :type constraints: dict
+        :param relax: drops the fewest constraints if they cannot be satisfied
         """
-        return self.vom.sample_sequence(length, constraints=constraints)
+        return self.vom.sample_sequence(length, constraints=constraints, relax=relax)
 
     def realize_vp_sequence(self, vp_seq):
         print(f"realize sequence of {len(vp_seq)} viewpoints")
         note_sequence = []
+        realizations = self.vom.realizations
         for i, vp in enumerate(vp_seq):
+            vp_id = self.vom.index_of_vp(vp)
             if i == 0:
-                initials = [real for real in self.vom.viewpoints_realizations[vp] if self.is_starting_address(real)]
+                initials = realizations.get_starts(vp_id)
                 if len(initials) != 0:
-                    note_sequence.append(random.choice(initials))
+                    note_sequence.append(initials.choice())
                     continue
             if i == len(vp_seq) - 1 and vp_seq[-1] == self.vom.end_padding:
-                lasts = [real for real in self.vom.viewpoints_realizations[vp] if self.is_ending_address(real)]
+                lasts = realizations.get_ends(vp_id)
                 if len(lasts) != 0:
-                    note_sequence.append(random.choice(lasts))
+                    note_sequence.append(lasts.choice())
                     continue
-            note_sequence.append(random.choice(self.vom.viewpoints_realizations[vp]))
+            note_sequence.append(realizations.get(vp_id).choice())
 
         # domains = [self.viewpoints_realizations[vp] for vp in vp_seq]
         # # # try to put together notes with compatible status @TODO
@@ -248,11 +281,11 @@ class Continuator2:
     def get_vp_for_pitch(self, pitch):
         # this is way too costly, but used only at constraint initialization. Can be cached
         vps = []
-        for vp, notes in self.vom.viewpoints_realizations.items():
+        for vp_id, notes in self.vom.realizations.items():
             for note_address in notes:
                 note = self.vom.get_input_object(note_address)
                 if note.pitch == pitch:
-                    vps.append(vp)
+                    vps.append(self.vom.vocabulary.viewpoint(vp_id))
         return random.choice(vps)
 
     def set_timing(self, idx_sequence):
@@ -16,6 +16,7 @@ import threading
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from ctor import augmentation
 from ctor.phrase_listener import MidiPhraseListener
 from ctor.continuator import Continuator2
 from io import BytesIO
@@ -76,11 +77,16 @@ class Continuator_gradio:
         constraints = {}
         # constraints[0] = self.continuator.get_vp_for_pitch(62)
         constraints[len(phrase)] = self.continuator.get_end_vp()
-        generated_sequence = self.continuator.sample_sequence(length=len(phrase) + 1, constraints=constraints)
+        # in live use, an answer without its end constraint is better than no answer
+        generated_sequence = self.continuator.sample_sequence(length=len(phrase) + 1, constraints=constraints,
+                                                              relax=True)
         if generated_sequence is None:
             print("no solution gradio")
             return
-        sequence_to_render = generated_sequence[:-1]
+        sequence_to_render = generated_sequence
+        # the end constraint may have been relaxed, then the last element is a note
+        if sequence_to_render and sequence_to_render[-1] is self.continuator.get_end_vp():
+            sequence_to_render = sequence_to_render[:-1]
         rendered_sequence = self.continuator.realize_vp_sequence(sequence_to_render)
         mido_sequence = self.continuator.create_mido_sequence(rendered_sequence)
         self.listener.play_phrase(mido_sequence)
@@ -201,6 +207,9 @@ class Continuator_gradio:
     def set_transpose(self, choice):
         self.continuator.set_transpose(choice == "Transpose")
 
+    def set_augmentations(self, choices):
+        self.continuator.set_augmentations(choices)
+
     def set_forget(self, choice):
         self.continuator.set_forget(choice == "Forget")
 
@@ -208,6 +217,10 @@ class Continuator_gradio:
         print("keep last " + str(choice))
         self.continuator.set_keep_last(choice)
 
+    def set_decay(self, choice):
+        print("decay " + str(choice))
+        self.continuator.set_decay(choice)
+
     def open_midi_files(self, files):
         midi_files = [f.name for f in files if f.name.lower().endswith('.mid') or f.name.lower().endswith('.midi')]
         # print ("\n".join(midi_files) if midi_files else "No MIDI files found.")
@@ -327,11 +340,17 @@ class Continuator_gradio:
                     transpose_choice = gr.Radio(choices=["Transpose", "Don't transpose"], label="Transpose",
                                                 value="Don't transpose")
                     transpose_choice.change(fn=self.set_transpose, inputs=transpose_choice)
+                    augmentation_choice = gr.CheckboxGroup(choices=list(augmentation.augmentations),
+                                                           label="Augmentations", value=[])
+                    augmentation_choice.change(fn=self.set_augmentations, inputs=augmentation_choice)
                     forget_choice = gr.Radio(choices=["Don't forget", "Forget"], label="Forget", value="Don't forget")
                     forget_choice.change(fn=self.set_forget, inputs=forget_choice)
                     keep_last_slider = gr.Slider(minimum=1, maximum=100, step=1, value=1,
                                                  label="Keep only N last inputs")
                     keep_last_slider.change(fn=self.set_keep_last, inputs=[keep_last_slider])
+                    decay_slider = gr.Slider(minimum=0.5, maximum=1, step=0.01, value=1,
+                                             label="Decay per phrase (1 for no decay)")
+                    decay_slider.change(fn=self.set_decay, inputs=[decay_slider])
         demo.launch()
 
 
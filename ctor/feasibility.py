@@ -0,0 +1,125 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import numpy as np
+
+from ctor.sparse_matrix import CSRMatrix
+
+"""
+Feasibility of the positional constraints of Variable_order_Markov.sample_sequence, without belief propagation:
+only the boolean structure of the transition matrix matters. As constraints fix values, the chain splits into
+independent segments between consecutive constraints, and the constraints can be satisfied iff each segment has
+a path, found by propagating sets of reachable values position by position.
+"""
+
+
+def successors(matrix, reached):
+    # values reachable in one transition from the values of the boolean vector reached
+    if isinstance(matrix, CSRMatrix):
+        return matrix.transpose().dot(reached.astype(matrix.dtype)) > 0
+    return reached.astype(matrix.dtype) @ matrix > 0
+
+
+def predecessors(matrix, reached):
+    # values from which a value of reached is reachable in one transition
+    return matrix.dot(reached.astype(matrix.dtype)) > 0
+
+
+class ConstraintChecker:
+    """
+    Checks constraints {position: value id} on a chain of length values, where matrix[a, b] > 0 iff b can follow a
+    (dense or CSRMatrix), and support is the boolean vector of the values allowed at unconstrained positions.
+    A check costs O(length * V^2), or O(length * nnz) with a sparse matrix.
+    In conflicts, None stands for the start or the end of the chain.
+    """
+
+    def __init__(self, matrix, length, support):
+        self.matrix = matrix
+        self.length = length
+        self.support = support
+
+    def reachable(self, position, value, targets):
+        """{target: boolean vector of the values reachable at target} for later target positions,
+        from value at position (value None: from any value of support at position 0),
+        through unconstrained positions"""
+        result = {}
+        if value is None:
+            # nothing before the first position, so any value can be fixed there
+            reached = self.support
+            if position in targets:
+                result[position] = np.ones(len(self.support), dtype=bool)
+        else:
+            reached = np.zeros(len(self.support), dtype=bool)
+            reached[value] = True
+        last = max(targets, default=position)
+        while position < last and reached.any():
+            image = successors(self.matrix, reached)
+            position += 1
+            if position in targets:
+                result[position] = image
+            reached = image & self.support
+        return {target: result.get(target, np.zeros(len(self.support), dtype=bool)) for target in targets}
+
+    def can_end(self, positions):
+        """{position: boolean vector of the values from which the end of the chain can be reached
+        through unconstrained positions} for the given positions"""
+        result = {}
+        reaching = np.ones(len(self.support), dtype=bool)
+        for position in range(self.length - 1, min(positions, default=self.length) - 1, -1):
+            if position in positions:
+                result[position] = reaching
+            reaching = predecessors(self.matrix, reaching & self.support)
+        return result
+
+    def conflicts(self, constraints):
+        # (position, next position) of the consecutive constraints that cannot be satisfied together
+        positions = sorted(constraints)
+        conflicts = []
+        for previous, position in zip([None] + positions, positions):
+            start = 0 if previous is None else previous
+            reached = self.reachable(start, constraints.get(previous), {position})[position]
+            if not reached[constraints[position]]:
+                conflicts.append((previous, position))
+        ends = self.can_end(set(positions) | {0})
+        if not positions:
+            if not (ends[0] & self.support).any():
+                conflicts.append((None, None))
+        elif not ends[positions[-1]][constraints[positions[-1]]]:
+            conflicts.append((positions[-1], None))
+        return conflicts
+
+    def relaxed(self, constraints):
+        """The largest subset of the constraints that can be satisfied, None if even no constraint can be.
+        Kept constraints form a path start -> constraints by position -> end of compatible consecutive constraints,
+        the longest one is found by dynamic programming"""
+        positions = sorted(constraints)
+        nodes = [None] + positions
+        ends = self.can_end(set(positions) | {0})
+        # best[i]: (number of constraints, previous node) of the longest path from the start to node i
+        best = [(0, None)] + [(-1, None)] * len(positions)
+        for i, node in enumerate(nodes):
+            if best[i][0] < 0:
+                continue
+            start = 0 if node is None else node
+            later = positions[i:]
+            reached = self.reachable(start, constraints.get(node), set(later))
+            for j, position in enumerate(later, i + 1):
+                if reached[position][constraints[position]] and best[i][0] + 1 > best[j][0]:
+                    best[j] = (best[i][0] + 1, i)
+        # the last kept constraint must reach the end
+        candidates = [i for i in range(1, len(nodes))
+                      if best[i][0] >= 0 and ends[nodes[i]][constraints[nodes[i]]]]
+        if not candidates:
+            if (ends[0] & self.support).any():
+                return {}
+            return None
+        i = max(candidates, key=lambda candidate: best[candidate][0])
+        kept = {}
+        while i:
+            kept[nodes[i]] = constraints[nodes[i]]
+            i = best[i][1]
+        return kept
@@ -0,0 +1,85 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import random
+
+
+class InterpolatedMarkov:
+    """
+    Weighted interpolation of several Variable_order_Markov at sampling time, e.g. to blend two styles
+    without merging their models (see Variable_order_Markov.merge).
+    Each continuation is drawn from sum_m weights[m] * p_m(. | generated sequence), where p_m is the distribution
+    model m would draw from, with its own backoff (see Variable_order_Markov.backoff_table).
+    Models keep their own vocabularies: each one follows the generated sequence with its own cursor,
+    and a viewpoint it does not know resets its context, so it does not contribute until its contexts match again.
+    """
+
+    def __init__(self, models, weights=None):
+        self.models = list(models)
+        self.weights = None
+        self.set_weights(weights)
+
+    def set_weights(self, weights=None):
+        # one weight per model, not necessarily normalized. Can be changed between two samplings
+        if weights is None:
+            weights = [1] * len(self.models)
+        if len(weights) != len(self.models):
+            print("one weight per model is needed")
+            return
+        total = sum(weights)
+        self.weights = [weight / total for weight in weights]
+
+    def start_cursors(self, kmax=None):
+        # the generation states of the models, after the start padding
+        return [model.cursor([model.start_id], kmax) for model in self.models]
+
+    @staticmethod
+    def append(models, cursors, vp):
+        for model, cursor in zip(models, cursors):
+            cursor.append(model.vocabulary.vp_to_id.get(vp, -1))
+
+    def continuation_distribution(self, cursors):
+        # viewpoint -> interpolated probability of being the next one (up to a constant factor),
+        # None stands for the end of a phrase
+        distribution = {}
+        for model, weight, cursor in zip(self.models, self.weights, cursors):
+            if weight == 0:
+                continue
+            table, vp_to_skip = model.backoff_table(cursor.context_tables())
+            if table is None:
+                continue
+            ids, counts, _ = table.arrays(model.decay)
+            total = sum(count for vp_id, count in zip(ids, counts) if vp_id != vp_to_skip)
+            for vp_id, count in zip(ids, counts):
+                if vp_id == vp_to_skip:
+                    continue
+                vp = None if vp_id == model.end_id else model.vocabulary.viewpoint(vp_id)
+                distribution[vp] = distribution.get(vp, 0) + weight * count / total
+        return distribution
+
+    def sample_sequence(self, length, start_vp=None, kmax=None):
+        # a sequence of at most length viewpoints, shorter if the end of a phrase is drawn
+        cursors = self.start_cursors(kmax)
+        sequence = []
+        if start_vp is not None:
+            self.append(self.models, cursors, start_vp)
+            sequence.append(start_vp)
+        while len(sequence) < length:
+            distribution = self.continuation_distribution(cursors)
+            if not distribution:
+                print("restarting from scratch")
+                cursors = self.start_cursors(kmax)
+                distribution = self.continuation_distribution(cursors)
+                if not distribution:
+                    # nothing learned
+                    break
+            vp = random.choices(list(distribution), weights=list(distribution.values()))[0]
+            if vp is None:
+                break
+            self.append(self.models, cursors, vp)
+            sequence.append(vp)
+        return sequence
@@ -0,0 +1,136 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import math
+import sys
+
+import numpy as np
+
+from ctor.sparse_matrix import CSRMatrix
+
+"""
+Estimation of the memory used by the structures of a Variable_order_Markov, and pruning of its contexts.
+Sizes are shallow sizes (sys.getsizeof) of the containers and of their keys, which is what grows with
+the number of contexts. Small ints and viewpoints shared with other structures are not counted twice.
+"""
+
+
+def table_bytes(table):
+    size = sys.getsizeof(table) + sys.getsizeof(table.counts)
+    if table.stamps is not None:
+        size += sys.getsizeof(table.stamps)
+    if table._ids is not None:
+        size += sys.getsizeof(table._ids) + sys.getsizeof(table._weights) + sys.getsizeof(table._cumulative)
+        size += table._id_array.nbytes
+    return size
+
+
+def context_bytes(context, table):
+    # a context key and its table. The slot in the dict is not counted, as dicts do not shrink when keys are removed
+    return sys.getsizeof(context) + table_bytes(table)
+
+
+def contexts_bytes(prefixes_to_cont_k):
+    return sys.getsizeof(prefixes_to_cont_k) + sum(
+        context_bytes(context, table) for context, table in prefixes_to_cont_k.items())
+
+
+def realizations_bytes(realizations):
+    size = realizations.nbytes()
+    for stores in (realizations.addresses, realizations.starts, realizations.ends, realizations.keys):
+        size += sys.getsizeof(stores) + sum(sys.getsizeof(store) for store in stores.values())
+    # with dedup, the addresses of the similar realizations of each key
+    for keys in realizations.keys.values():
+        size += sum(sys.getsizeof(similar[1]) + len(similar[1]) * sys.getsizeof((0, 0)) for similar in keys.values())
+    return size
+
+
+def vocabulary_bytes(vocabulary):
+    size = sys.getsizeof(vocabulary.vp_to_id) + sys.getsizeof(vocabulary.id_to_vp) + sys.getsizeof(vocabulary.counts)
+    size += sys.getsizeof(vocabulary.free_ids)
+    return size + sum(sys.getsizeof(vp) for vp in vocabulary.id_to_vp if vp is not None)
+
+
+def transition_matrix_bytes(matrix):
+    if hasattr(matrix, "rows"):
+        # sparse matrix
+        size = sys.getsizeof(matrix.rows) + sum(sys.getsizeof(row) for row in matrix.rows)
+        size += sum(indices.nbytes + data.nbytes for indices, data in zip(matrix._row_indices, matrix._row_data))
+        if isinstance(matrix._normalized, CSRMatrix):
+            size += matrix._normalized.indptr.nbytes + matrix._normalized.indices.nbytes
+            size += matrix._normalized.data.nbytes
+        return size
+    size = matrix.counts.nbytes + matrix.stamps.nbytes
+    # the normalized matrices are allocated when first used
+    for normalized in (matrix._normalized, matrix._transposed):
+        if normalized is not None:
+            size += normalized.nbytes
+    return size
+
+
+def suffix_automaton_bytes(automaton):
+    size = sum(sys.getsizeof(lst) for lst in
+               [automaton.transitions, automaton.links, automaton.lengths, automaton.end_counts,
+                automaton.tail_positions])
+    return size + sum(sys.getsizeof(transitions) for transitions in automaton.transitions)
+
+
+def frequency_score(context, table, parent, decay):
+    # the number of occurrences of the context
+    return table.get_total(decay)
+
+
+def entropy_score(context, table, parent, decay):
+    # relative entropy pruning: the number of occurrences of the context times the Kullback-Leibler divergence
+    # between its continuations and those of its parent (the context without its oldest element).
+    # A context that predicts the same continuations as its parent adds no information
+    if parent is None:
+        return frequency_score(context, table, parent, decay)
+    ids = table.ids()
+    weights = np.array(table.weights(ids, decay), dtype=np.float64)
+    # with decay, weights are relative to the latest update among the ids passed, so the weights of the parent
+    # are all computed by one call
+    parent_ids = parent.ids()
+    parent_weights = dict(zip(parent_ids, parent.weights(parent_ids, decay)))
+    p = weights / weights.sum()
+    q = np.array([parent_weights.get(vp_id, 0) for vp_id in ids], dtype=np.float64) / sum(parent_weights.values())
+    # continuations the parent lost by pruning are ignored, instead of giving an infinite score
+    seen = q > 0
+    divergence = float(np.sum(p[seen] * np.log(p[seen] / q[seen])))
+    return table.get_total(decay) * max(divergence, 0.0)
+
+
+pruning_policies = {"frequency": frequency_score, "entropy": entropy_score}
+
+
+def prune_contexts(model, bytes_to_free, policy="frequency"):
+    """Removes contexts of order >= 2 with the lowest scores until bytes_to_free are freed, returns the freed bytes.
+    The score of a context is raised to the scores of its extensions (contexts it is a prefix or a suffix of),
+    and contexts are removed by increasing score then decreasing order, so that an extension is always removed
+    before its sub-contexts: the remaining contexts stay suffix and prefix closed, as after learning"""
+    score_function = pruning_policies[policy]
+    decay = model.decay
+    contexts = model.prefixes_to_continuations
+    scores = {}
+    for k in range(len(contexts) - 1, 0, -1):
+        for context, table in contexts[k].items():
+            score = score_function(context, table, contexts[k - 1].get(context[1:]), decay)
+            scores[context] = max(score, scores.get(context, -math.inf))
+            if k > 1:
+                # propagates to the suffix and prefix sub-contexts
+                for sub_context in (context[1:], context[:-1]):
+                    if scores.get(sub_context, -math.inf) < scores[context]:
+                        scores[sub_context] = scores[context]
+    candidates = sorted(scores, key=lambda context: (scores[context], -len(context)))
+    freed = 0
+    for context in candidates:
+        if freed >= bytes_to_free:
+            break
+        table = contexts[len(context) - 1].pop(context, None)
+        if table is not None:
+            freed += context_bytes(context, table)
+    return freed
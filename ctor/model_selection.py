@@ -0,0 +1,84 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import math
+import multiprocessing
+import random
+
+from ctor.variable_order_markov import Variable_order_Markov
+
+"""
+Choice of the parameters of a Variable_order_Markov by cross-validation: the sequences are split in folds,
+and each fold is scored (see Variable_order_Markov.perplexity) by a model learned on the other folds.
+A model learned with the largest kmax is scored for each smaller kmax, as contexts do not depend on kmax.
+Folds and views options are evaluated in parallel processes.
+"""
+
+# the sequences, set in each process by the pool initializer, so they are not sent with each job
+_sequences = None
+
+
+def _set_sequences(sequences):
+    global _sequences
+    _sequences = sequences
+
+
+def fold_scores(job):
+    # (sum of log probabilities, number of scored elements) of a test fold for each kmax
+    viewpoint_function, train, test, kmax_values, views, epsilon, model_arguments = job
+    model = Variable_order_Markov(None, viewpoint_function, max(kmax_values), **model_arguments)
+    model.learn_sequences([_sequences[i] for i in train], views=views)
+    scores = []
+    for kmax in kmax_values:
+        log_probabilities = [model.log_probabilities(_sequences[i], kmax, epsilon) for i in test]
+        scores.append((sum(float(logs.sum()) for logs in log_probabilities),
+                       sum(len(logs) for logs in log_probabilities)))
+    model.close()
+    return scores
+
+
+def cross_validate(sequences, viewpoint_function, kmax_values, views_options=None, folds=5, processes=None,
+                   epsilon=1e-9, seed=0, **model_arguments):
+    """Returns {(kmax, views name): perplexity} of the sequences, for each kmax and each views option.
+    views_options maps names to lists of views used for learning (see augmentation), by default learning as is.
+    processes is the number of worker processes (by default the number of cores), 1 to run in this process.
+    model_arguments are passed to Variable_order_Markov (e.g. sparse=True)"""
+    if views_options is None:
+        views_options = {"no views": None}
+    kmax_values = list(kmax_values)
+    folds = min(folds, len(sequences))
+    if folds < 2:
+        print("cross validation needs at least 2 sequences")
+        return {}
+    indexes = list(range(len(sequences)))
+    random.Random(seed).shuffle(indexes)
+    test_folds = [indexes[f::folds] for f in range(folds)]
+    jobs = []
+    for views in views_options.values():
+        for test in test_folds:
+            test_set = set(test)
+            train = [i for i in indexes if i not in test_set]
+            jobs.append((viewpoint_function, train, test, kmax_values, views, epsilon, model_arguments))
+    if processes == 1:
+        _set_sequences(sequences)
+        results = [fold_scores(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(processes, initializer=_set_sequences, initargs=(sequences,)) as pool:
+            results = pool.map(fold_scores, jobs)
+    perplexities = {}
+    for v, name in enumerate(views_options):
+        fold_results = results[v * folds:(v + 1) * folds]
+        for j, kmax in enumerate(kmax_values):
+            log_probability = sum(scores[j][0] for scores in fold_results)
+            count = sum(scores[j][1] for scores in fold_results)
+            perplexities[(kmax, name)] = math.exp(-log_probability / count)
+    return perplexities
+
+
+def best_parameters(perplexities):
+    # the (kmax, views name) with the lowest perplexity
+    return min(perplexities, key=perplexities.get)
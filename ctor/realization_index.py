@@ -0,0 +1,251 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import random
+
+import numpy as np
+
+
+class AddressStore:
+    """
+    Growable int32 array of addresses (sequence id, index in sequence), in array[begin:end].
+    Addresses are returned as tuples, as elsewhere in the model.
+    Sequences are learned with increasing ids, so addresses are usually ordered by sequence id: removing a sequence
+    is then a binary search, and removing the oldest one (as when forgetting the past) only moves begin.
+    """
+
+    __slots__ = ("array", "begin", "end", "ordered")
+
+    def __init__(self, capacity=4):
+        self.array = np.zeros((capacity, 2), dtype=np.int32)
+        self.begin = 0
+        self.end = 0
+        # whether the addresses are ordered by sequence id
+        self.ordered = True
+
+    def __len__(self):
+        return self.end - self.begin
+
+    def __getitem__(self, i):
+        sequence_id, index = self.array[self.begin + i].tolist()
+        return sequence_id, index
+
+    def __iter__(self):
+        for sequence_id, index in self.live().tolist():
+            yield sequence_id, index
+
+    def live(self):
+        # the addresses as an (n, 2) array view
+        return self.array[self.begin:self.end]
+
+    def _reserve(self, extra):
+        if self.end + extra > len(self.array):
+            # the removed addresses before begin are dropped
+            array = np.zeros((max(len(self) + extra, 2 * len(self), 4), 2), dtype=np.int32)
+            array[:len(self)] = self.live()
+            self.array = array
+            self.end = len(self)
+            self.begin = 0
+
+    def append(self, sequence_id, index):
+        if len(self) > 0 and self.array[self.end - 1, 0] > sequence_id:
+            self.ordered = False
+        self._reserve(1)
+        self.array[self.end] = (sequence_id, index)
+        self.end += 1
+
+    def extend(self, addresses):
+        # addresses is an (n, 2) array
+        if len(addresses) == 0:
+            return
+        if self.ordered and (np.any(np.diff(addresses[:, 0]) < 0)
+                             or (len(self) > 0 and self.array[self.end - 1, 0] > addresses[0, 0])):
+            self.ordered = False
+        self._reserve(len(addresses))
+        self.array[self.end:self.end + len(addresses)] = addresses
+        self.end += len(addresses)
+
+    def remove_sequence(self, sequence_id):
+        live = self.live()
+        if self.ordered:
+            first, last = np.searchsorted(live[:, 0], [sequence_id, sequence_id + 1]).tolist()
+            if first == 0:
+                self.begin += last
+            elif first < last:
+                live[first:len(live) - (last - first)] = live[last:].copy()
+                self.end -= last - first
+            return
+        kept = live[live[:, 0] != sequence_id]
+        self.array[:len(kept)] = kept
+        self.begin = 0
+        self.end = len(kept)
+        self.ordered = bool(np.all(np.diff(kept[:, 0]) >= 0))
+
+    def choice(self):
+        # same draw as random.choice on a list of addresses
+        return self[random.randrange(len(self))]
+
+    def nbytes(self):
+        return self.array.nbytes
+
+
+# returned for viewpoints without realizations
+_EMPTY_STORE = AddressStore(0)
+
+
+def realization_key(obj):
+    # the key of an object for deduplication: objects with the same key are similar realizations
+    # (see Note.realization_key). Other objects are their own key
+    key_function = getattr(obj, "realization_key", None)
+    if key_function is None:
+        return obj
+    return key_function()
+
+
+class RealizationIndex:
+    """
+    The realizations (addresses of input objects) of each vp id, in an AddressStore per vp id.
+    The starting and ending realizations are also stored apart, so that they are drawn in O(1) at rendering time.
+    With dedup, a realization is stored only if no similar realization (same realization_key) is stored for the
+    same vp id: the addresses of similar realizations are kept apart, and the stored one is replaced by one of them,
+    in O(1), if its sequence is removed. Starting and ending realizations are always stored.
+    """
+
+    def __init__(self, dedup=False):
+        self.dedup = dedup
+        self.addresses = {}
+        self.starts = {}
+        self.ends = {}
+        # only with dedup: vp id -> {key: [stored address, set of the addresses of the similar realizations]}
+        self.keys = {}
+
+    def __contains__(self, vp_id):
+        return vp_id in self.addresses
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def get(self, vp_id):
+        return self.addresses.get(vp_id, _EMPTY_STORE)
+
+    def get_starts(self, vp_id):
+        return self.starts.get(vp_id, _EMPTY_STORE)
+
+    def get_ends(self, vp_id):
+        return self.ends.get(vp_id, _EMPTY_STORE)
+
+    def items(self):
+        return self.addresses.items()
+
+    def total(self):
+        return sum(len(store) for store in self.addresses.values())
+
+    @staticmethod
+    def _store(stores, vp_id):
+        store = stores.get(vp_id)
+        if store is None:
+            store = stores[vp_id] = AddressStore()
+        return store
+
+    def add(self, vp_id, sequence_id, index, start=False, end=False, key=None):
+        # key is the realization key of the object, used with dedup
+        if start:
+            self._store(self.starts, vp_id).append(sequence_id, index)
+        if end:
+            self._store(self.ends, vp_id).append(sequence_id, index)
+        if self.dedup and not start and not end:
+            keys = self.keys.setdefault(vp_id, {})
+            similar = keys.get(key)
+            if similar is not None:
+                similar[1].add((sequence_id, index))
+                return
+            keys[key] = [(sequence_id, index), {(sequence_id, index)}]
+        self._store(self.addresses, vp_id).append(sequence_id, index)
+
+    def extend(self, vp_id, addresses):
+        # adds many (n, 2) addresses without dedup. Starting and ending ones must also be given to add_boundary
+        self._store(self.addresses, vp_id).extend(addresses)
+
+    def add_boundary(self, vp_id, sequence_id, index, start, end):
+        # adds a starting or ending realization to the sub-indexes only
+        if start:
+            self._store(self.starts, vp_id).append(sequence_id, index)
+        if end:
+            self._store(self.ends, vp_id).append(sequence_id, index)
+
+    def remove(self, vp_id, sequence_id, realizations=()):
+        """Removes the realizations of vp_id in a sequence. realizations are the (address, realization key) of the
+        removed realizations that are neither starting nor ending, used with dedup: a stored realization that
+        still has similar ones is replaced by one of them"""
+        for stores in (self.addresses, self.starts, self.ends):
+            store = stores.get(vp_id)
+            if store is not None:
+                store.remove_sequence(sequence_id)
+                if len(store) == 0:
+                    del stores[vp_id]
+        if not self.dedup or vp_id not in self.keys:
+            return
+        vp_keys = self.keys[vp_id]
+        lost = []
+        for address, key in realizations:
+            similar = vp_keys[key]
+            similar[1].discard(address)
+            if not similar[1]:
+                del vp_keys[key]
+            elif similar[0] == address:
+                lost.append(key)
+        for key in lost:
+            similar = vp_keys.get(key)
+            if similar is not None and similar[0][0] == sequence_id:
+                # all the similar realizations of the sequence are discarded, the replacement is in another one
+                similar[0] = next(iter(similar[1]))
+                self._store(self.addresses, vp_id).append(*similar[0])
+        if not vp_keys:
+            del self.keys[vp_id]
+
+    def merge(self, other, vp_ids, sequence_ids):
+        # adds the realizations of another index with the same dedup, e.g. when merging models.
+        # vp_ids and sequence_ids map the vp ids and the sequence ids of other to ours
+        old_sequence_ids = np.array(sorted(sequence_ids), dtype=np.int64)
+        new_sequence_ids = np.array([sequence_ids[i] for i in old_sequence_ids.tolist()], dtype=np.int32)
+
+        def remap(store):
+            addresses = store.live().copy()
+            addresses[:, 0] = new_sequence_ids[np.searchsorted(old_sequence_ids, addresses[:, 0])]
+            return addresses
+
+        for stores, other_stores in ((self.starts, other.starts), (self.ends, other.ends)):
+            for vp_id, store in other_stores.items():
+                self._store(stores, vp_ids[vp_id]).extend(remap(store))
+        for vp_id, store in other.addresses.items():
+            addresses = remap(store)
+            if not self.dedup:
+                self._store(self.addresses, vp_ids[vp_id]).extend(addresses)
+                continue
+            # similar realizations are counted once, representatives of known keys are not stored
+            representatives = {address: key for key, (address, _) in other.keys.get(vp_id, {}).items()}
+            keys = self.keys.setdefault(vp_ids[vp_id], {})
+            for old, new in zip(store, addresses.tolist()):
+                new = tuple(new)
+                key = representatives.get(old)
+                if key is not None:
+                    similar_addresses = {(sequence_ids[similar_id], index)
+                                         for similar_id, index in other.keys[vp_id][key][1]}
+                    similar = keys.get(key)
+                    if similar is not None:
+                        similar[1].update(similar_addresses)
+                        continue
+                    keys[key] = [new, similar_addresses]
+                self._store(self.addresses, vp_ids[vp_id]).append(*new)
+            if not keys:
+                del self.keys[vp_ids[vp_id]]
+
+    def nbytes(self):
+        size = 0
+        for stores in (self.addresses, self.starts, self.ends):
+            size += sum(store.nbytes() for store in stores.values())
+        return size
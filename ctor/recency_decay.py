@@ -0,0 +1,27 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+
+class RecencyDecay:
+    """
+    Exponential forgetting of learned counts: a count learned n phrases ago weighs rate ** n.
+    Decay is lazy: counts are stored with the time of their last update, and are only brought
+    to the current time when they are updated or read, so learning never rewrites old counts.
+    """
+
+    def __init__(self, rate):
+        # weight multiplier per learned phrase, in ]0, 1]
+        self.rate = rate
+        # the global time stamp, i.e. the number of phrases learned with decay
+        self.time = 0
+
+    def tick(self):
+        self.time += 1
+
+    def factor(self, stamp):
+        # the decay of a count last updated at time stamp. Works with numpy arrays of stamps
+        return self.rate ** (self.time - stamp)
@@ -0,0 +1,124 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import multiprocessing
+
+from ctor import memory_usage
+from ctor.continuation_table import ContinuationTable
+
+
+def serve(connection, nb_orders):
+    # the loop of a shard process: contexts[k] maps the contexts of k + 1 vp ids of the shard to their tables
+    contexts = [{} for _ in range(nb_orders)]
+    while True:
+        command, arguments = connection.recv()
+        if command == "add":
+            items, decay = arguments
+            for k, context, vp_id, count in items:
+                table = contexts[k].get(context)
+                if table is None:
+                    table = contexts[k][context] = ContinuationTable()
+                table.add(vp_id, count, decay)
+        elif command == "remove":
+            items, decay = arguments
+            for k, context, vp_id, count in items:
+                table = contexts[k].get(context)
+                if table is None:
+                    continue
+                table.remove(vp_id, count, decay)
+                if table.distinct == 0:
+                    del contexts[k][context]
+        elif command == "get":
+            connection.send([contexts[k].get(context) for k, context in arguments])
+        elif command == "sizes":
+            connection.send([(len(contexts_k), memory_usage.contexts_bytes(contexts_k)) for contexts_k in contexts])
+        elif command == "clear":
+            contexts = [{} for _ in range(nb_orders)]
+        elif command == "close":
+            connection.close()
+            return
+
+
+class ShardedContexts:
+    """
+    Context tables held by worker processes, for corpora whose contexts do not fit in one process.
+    Each context is owned by the shard of its hash, and requests are batched: a batch of updates is one message
+    per shard, and a batch of lookups is one round trip per shard, all shards working in parallel.
+    Updates are not acknowledged, but each shard processes its messages in order, so a lookup sees all the
+    updates sent before it. Looked up tables are copies, they must not be updated.
+    """
+
+    def __init__(self, nb_shards, nb_orders):
+        self.nb_orders = nb_orders
+        self.connections = []
+        self.processes = []
+        for _ in range(nb_shards):
+            connection, child_connection = multiprocessing.Pipe()
+            # daemon processes end with the main process
+            process = multiprocessing.Process(target=serve, args=(child_connection, nb_orders), daemon=True)
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def shard(self, context):
+        return hash(context) % len(self.connections)
+
+    def split(self, items):
+        # items grouped by shard, items start with (k, context)
+        batches = [[] for _ in self.connections]
+        for item in items:
+            batches[self.shard(item[1])].append(item)
+        return batches
+
+    def send(self, command, items, decay=None):
+        for connection, batch in zip(self.connections, self.split(items)):
+            if batch:
+                connection.send((command, (batch, decay)))
+
+    def add(self, items, decay=None):
+        # items are (k, context, vp id, count)
+        self.send("add", items, decay)
+
+    def remove(self, items, decay=None):
+        # items are (k, context, vp id, count). Contexts with no more continuations are removed
+        self.send("remove", items, decay)
+
+    def get(self, keys):
+        # the tables of (k, context) keys, None for unknown contexts
+        batches = self.split(keys)
+        for connection, batch in zip(self.connections, batches):
+            if batch:
+                connection.send(("get", batch))
+        tables = {}
+        for connection, batch in zip(self.connections, batches):
+            if batch:
+                tables.update(zip(batch, connection.recv()))
+        return [tables[key] for key in keys]
+
+    def sizes(self):
+        # (number of contexts, bytes) for each order, summed over the shards
+        for connection in self.connections:
+            connection.send(("sizes", None))
+        sizes = [(0, 0)] * self.nb_orders
+        for connection in self.connections:
+            sizes = [(n + shard_n, size + shard_size)
+                     for (n, size), (shard_n, shard_size) in zip(sizes, connection.recv())]
+        return sizes
+
+    def clear(self):
+        for connection in self.connections:
+            connection.send(("clear", None))
+
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(("close", None))
+            process.join()
+        self.connections = []
+        self.processes = []
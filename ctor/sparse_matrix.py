@@ -0,0 +1,96 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import numpy as np
+
+
+class CSRMatrix:
+    """
+    A minimal compressed sparse row matrix, backed by numpy arrays.
+    Only implements what belief propagation needs: products with vectors (or batches of vectors),
+    transposition, and row extraction.
+    """
+
+    def __init__(self, indptr, indices, data, shape):
+        # row i has its non zero values in data[indptr[i]:indptr[i + 1]], at columns indices[indptr[i]:indptr[i + 1]]
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data)
+        self.shape = tuple(shape)
+        self._transpose = None
+        # starts of non empty rows, for np.add.reduceat which does not handle empty segments
+        self._nonempty_rows = np.flatnonzero(self.indptr[:-1] < self.indptr[1:])
+        self._row_starts = self.indptr[self._nonempty_rows]
+
+    @classmethod
+    def from_dense(cls, array):
+        rows, cols = np.nonzero(array)
+        indptr = np.zeros(array.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=array.shape[0]), out=indptr[1:])
+        return cls(indptr, cols, array[rows, cols], array.shape)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def astype(self, dtype):
+        return CSRMatrix(self.indptr, self.indices, self.data.astype(dtype), self.shape)
+
+    def dot(self, vector):
+        # self @ vector. vector can be 1d, or 2d with one column per vector of a batch
+        products = self.data.reshape((-1,) + (1,) * (vector.ndim - 1)) * vector[self.indices]
+        result = np.zeros((self.shape[0],) + vector.shape[1:], dtype=products.dtype)
+        if len(self._row_starts) > 0:
+            result[self._nonempty_rows] = np.add.reduceat(products, self._row_starts, axis=0)
+        return result
+
+    def transpose(self):
+        # computed once and cached, the matrix is immutable
+        if self._transpose is None:
+            rows = np.repeat(np.arange(self.shape[0], dtype=np.int32), np.diff(self.indptr))
+            order = np.argsort(self.indices, kind="stable")
+            indptr = np.zeros(self.shape[1] + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.indices, minlength=self.shape[1]), out=indptr[1:])
+            self._transpose = CSRMatrix(indptr, rows[order], self.data[order], (self.shape[1], self.shape[0]))
+            self._transpose._transpose = self
+        return self._transpose
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def row(self, i):
+        # row i as a dense vector
+        result = np.zeros(self.shape[1], dtype=self.dtype)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        result[self.indices[start:end]] = self.data[start:end]
+        return result
+
+    def rows(self, ids, fill=0):
+        # rows ids as a dense (len(ids), columns) array, missing values being fill
+        ids = np.asarray(ids)
+        starts = self.indptr[ids]
+        lengths = self.indptr[ids + 1] - starts
+        # positions in data of the non zero values of the rows, row after row
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.repeat(starts, lengths) + offsets
+        result = np.full((len(ids), self.shape[1]), fill, dtype=self.dtype)
+        result[np.repeat(np.arange(len(ids)), lengths), self.indices[positions]] = self.data[positions]
+        return result
+
+    def toarray(self):
+        result = np.zeros(self.shape, dtype=self.dtype)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        result[rows, self.indices] = self.data
+        return result
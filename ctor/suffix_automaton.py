@@ -0,0 +1,157 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import numpy as np
+
+from ctor.continuation_table import ContinuationTable
+
+
+class SuffixAutomaton:
+    """
+    Generalized suffix automaton over int-coded sequences.
+    Each state stands for a set of contexts (substrings of the training sequences) that have the same end positions,
+    hence the same continuations: the continuations of a state are its outgoing transitions, and the count
+    of a continuation is the number of occurrences of the target state.
+    The automaton has at most 2n states for n learned symbols, whatever the order used at sampling time.
+    Sequences can be added incrementally; occurrence counts and continuation tables are recomputed lazily.
+    As in the per order dicts of Variable_order_Markov, a context of length k only counts the continuations
+    followed by at least k - 1 elements, so the end padding is only a continuation of order 1 contexts.
+    The distances to the end are tracked for the last tail positions of each sequence: counts are the same as the
+    dicts up to order tail + 1, and higher orders only skip the last tail positions.
+    """
+
+    def __init__(self, tail=1):
+        self.tail = tail
+        # per state: outgoing transitions (vp id -> state), suffix link, length of the longest context
+        self.transitions = [{}]
+        self.links = [-1]
+        self.lengths = [0]
+        # number of training positions for which the state is the longest context, i.e. not a clone
+        self.end_counts = [0]
+        # (state, distance to the end of the sequence) of the training positions at distance < tail
+        self.tail_positions = []
+        # lazily computed from end_counts: number of occurrences of the contexts of each state
+        self._occurrences = None
+        # (state, number of tail distances skipped) -> ContinuationTable, lazily computed
+        self._tables = {}
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def _new_state(self, length, link=-1, transitions=None):
+        self.transitions.append({} if transitions is None else dict(transitions))
+        self.links.append(link)
+        self.lengths.append(length)
+        self.end_counts.append(0)
+        return len(self.lengths) - 1
+
+    def _split(self, p, q, c):
+        # clones q so that the contexts of length lengths[p] + 1 get their own state
+        clone = self._new_state(self.lengths[p] + 1, self.links[q], self.transitions[q])
+        while p != -1 and self.transitions[p].get(c) == q:
+            self.transitions[p][c] = clone
+            p = self.links[p]
+        self.links[q] = clone
+        return clone
+
+    def _extend(self, last, c):
+        # adds symbol c after the context represented by state last, returns the new last state
+        if c in self.transitions[last]:
+            # the extended context already exists (it occurred in another sequence)
+            q = self.transitions[last][c]
+            if self.lengths[last] + 1 == self.lengths[q]:
+                return q
+            return self._split(last, q, c)
+        current = self._new_state(self.lengths[last] + 1)
+        p = last
+        while p != -1 and c not in self.transitions[p]:
+            self.transitions[p][c] = current
+            p = self.links[p]
+        if p == -1:
+            self.links[current] = 0
+        else:
+            q = self.transitions[p][c]
+            if self.lengths[p] + 1 == self.lengths[q]:
+                self.links[current] = q
+            else:
+                self.links[current] = self._split(p, q, c)
+        return current
+
+    def add_sequence(self, id_sequence):
+        last = 0
+        id_sequence = np.asarray(id_sequence).tolist()
+        for i, c in enumerate(id_sequence):
+            last = self._extend(last, c)
+            self.end_counts[last] += 1
+            distance = len(id_sequence) - 1 - i
+            if distance < self.tail:
+                self.tail_positions.append((last, distance))
+        self._occurrences = None
+        self._tables = {}
+
+    def occurrences(self):
+        """(states, tail + 1) array: the occurrences of the contexts of each state followed by at least m elements
+        in their sequence, for m <= tail. Column 0 holds all the occurrences"""
+        if self._occurrences is None:
+            # the occurrences of a state are the sum of the end counts in its suffix link subtree
+            lengths = np.array(self.lengths)
+            occurrences = np.zeros((len(lengths), self.tail + 1), dtype=np.int64)
+            occurrences[:, self.tail] = self.end_counts
+            for state, distance in self.tail_positions:
+                occurrences[state, distance] += 1
+                occurrences[state, self.tail] -= 1
+            for state in np.argsort(-lengths, kind="stable").tolist():
+                if self.links[state] >= 0:
+                    occurrences[self.links[state]] += occurrences[state]
+            # from the occurrences at each distance < tail, and at larger distances
+            self._occurrences = np.cumsum(occurrences[:, ::-1], axis=1)[:, ::-1]
+        return self._occurrences
+
+    def continuation_table(self, state, k=1):
+        # the continuations of the contexts of length k of a state, followed by at least k - 1 elements
+        skipped = min(k - 1, self.tail)
+        table = self._tables.get((state, skipped))
+        if table is None:
+            counts = self.occurrences()[:, skipped]
+            table = ContinuationTable({c: int(counts[target]) for c, target in self.transitions[state].items()
+                                       if counts[target] > 0})
+            self._tables[(state, skipped)] = table
+        return table
+
+    def step(self, state, length, c):
+        # the longest context after appending c to a sequence whose longest context is (state, length)
+        # amortized O(1): each suffix link followed shortens the context
+        while state != 0 and c not in self.transitions[state]:
+            state = self.links[state]
+            length = self.lengths[state]
+        if c in self.transitions[state]:
+            return self.transitions[state][c], length + 1
+        return state, length
+
+    def longest_context(self, id_sequence):
+        # returns (state, length) for the longest suffix of id_sequence that occurs in the training sequences
+        state = 0
+        length = 0
+        for c in id_sequence:
+            state, length = self.step(state, length, c)
+        return state, length
+
+    def context_tables(self, id_sequence):
+        # yields (k, table) for the suffixes of id_sequence of length k that have continuations, longest first
+        return self.tables_from(*self.longest_context(id_sequence))
+
+    def tables_from(self, state, length, kmax=None):
+        # same as context_tables, from the longest context (state, length), and for k <= kmax
+        if kmax is not None and length > kmax:
+            length = kmax
+        for k in range(length, 0, -1):
+            # the contexts of a state have lengths in ]lengths[link], lengths[state]]
+            while k <= self.lengths[self.links[state]]:
+                state = self.links[state]
+            table = self.continuation_table(state, k)
+            if table.distinct > 0:
+                yield k, table
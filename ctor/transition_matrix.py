@@ -0,0 +1,303 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import numpy as np
+
+from ctor.sparse_matrix import CSRMatrix
+
+
+class TransitionMatrix:
+    """
+    First-order transition counts between vp ids, updated in place when sequences are learned.
+    The matrix grows (by GROWTH times its capacity) when new viewpoints appear.
+    The row-normalized matrix and its transpose are allocated the first time they are used, then kept alongside
+    the counts: only the rows touched since the last call are renormalized, so learning a phrase costs
+    O(phrase length * V), not O(V^2). Dense matrices still take O(V^2) memory: use SparseTransitionMatrix
+    (sparse=True) for large vocabularies.
+    The arrays returned by normalized() and transposed() are views on internal buffers:
+    they must not be modified, and are updated in place by the next learn.
+    dtype is the type of the normalized views (counts are always float64), e.g. float32 to halve memory bandwidth.
+    With a RecencyDecay, each row has the time stamp of its last update, and is decayed when it is updated.
+    Decaying a whole row does not change its normalization, so rows that are not updated are never touched.
+    """
+
+    # capacity multiplier when the matrix grows
+    GROWTH = 1.5
+    # number of viewpoints above which a message suggests the sparse matrix
+    LARGE_SIZE = 4096
+
+    def __init__(self, capacity=16, dtype=np.float64):
+        self.size = 0
+        self.dtype = np.dtype(dtype)
+        # incremented at each change, so that results computed from the matrix can be cached (see ChainBP)
+        self.version = 0
+        self.counts = np.zeros((capacity, capacity))
+        # None until normalized() and transposed() are called
+        self._normalized = None
+        self._transposed = None
+        # time of the last update of each row, only used with decay
+        self.stamps = np.zeros(capacity, dtype=np.int64)
+        # rows whose counts changed since the last normalization
+        self._dirty_rows = set()
+
+    def capacity(self):
+        return self.counts.shape[0]
+
+    def resize(self, size):
+        if size > self.capacity():
+            if size > self.LARGE_SIZE >= self.capacity():
+                print(f"{size} viewpoints: the dense transition matrix takes O(V^2) memory, consider sparse=True")
+            new_capacity = max(size, int(self.GROWTH * self.capacity()))
+            for name in ["counts", "_normalized", "_transposed"]:
+                old = getattr(self, name)
+                if old is None:
+                    continue
+                new = np.zeros((new_capacity, new_capacity), dtype=old.dtype)
+                new[:self.size, :self.size] = old[:self.size, :self.size]
+                setattr(self, name, new)
+            stamps = np.zeros(new_capacity, dtype=np.int64)
+            stamps[:self.size] = self.stamps[:self.size]
+            self.stamps = stamps
+        if size > self.size:
+            self.version += 1
+        self.size = max(self.size, size)
+
+    def _decay_rows(self, rows, decay):
+        # brings the counts of rows to the current time
+        self.counts[rows, :self.size] *= decay.factor(self.stamps[rows])[:, None]
+        self.stamps[rows] = decay.time
+
+    def add_sequence(self, id_sequence, count=1, decay=None):
+        # counts all the transitions between consecutive ids
+        ids = np.asarray(id_sequence)
+        self.add_transitions(ids[:-1], ids[1:], count, decay)
+
+    def add_transitions(self, from_ids, to_ids, count=1, decay=None):
+        # counts the transitions from_ids[i] -> to_ids[i], e.g. for many sequences at once
+        self.version += 1
+        if decay is not None:
+            self._decay_rows(np.unique(from_ids), decay)
+        np.add.at(self.counts, (from_ids, to_ids), count)
+        self._dirty_rows.update(np.unique(from_ids).tolist())
+
+    def remove_sequence(self, id_sequence, count=1, decay=None):
+        # count is the current weight of the sequence
+        self.version += 1
+        ids = np.asarray(id_sequence)
+        if decay is not None:
+            self._decay_rows(np.unique(ids[:-1]), decay)
+        np.subtract.at(self.counts, (ids[:-1], ids[1:]), count)
+        # a small tolerance for decayed counts, so that removed transitions are exactly 0
+        removed = self.counts[ids[:-1], ids[1:]] <= 1e-9 * count
+        self.counts[ids[:-1][removed], ids[1:][removed]] = 0
+        self._dirty_rows.update(ids[:-1].tolist())
+
+    def add(self, from_id, to_id, count=1):
+        self.version += 1
+        self.counts[from_id, to_id] += count
+        self._dirty_rows.add(from_id)
+
+    def add_weighted(self, from_ids, to_ids, weights, decay=None):
+        # adds weights[i] to the transition from_ids[i] -> to_ids[i], e.g. when merging models.
+        # Negative weights subtract, and transitions that drop to about 0 are removed
+        self.version += 1
+        if decay is not None:
+            self._decay_rows(np.unique(from_ids), decay)
+        np.add.at(self.counts, (from_ids, to_ids), weights)
+        removed = self.counts[from_ids, to_ids] <= 1e-9 * np.abs(weights)
+        self.counts[from_ids[removed], to_ids[removed]] = 0
+        self._dirty_rows.update(np.unique(from_ids).tolist())
+
+    def transitions(self, decay=None):
+        # (from ids, to ids, current weights) of the non zero transitions
+        from_ids, to_ids = np.nonzero(self.get_counts())
+        weights = self.counts[from_ids, to_ids]
+        if decay is not None:
+            weights = weights * decay.factor(self.stamps[from_ids])
+        return from_ids, to_ids, weights
+
+    def get_counts(self):
+        return self.counts[:self.size, :self.size]
+
+    def _update(self):
+        if self._normalized is None:
+            # first use: all the rows are normalized at once
+            totals = self.counts.sum(axis=1, keepdims=True)
+            self._normalized = np.divide(self.counts, totals, out=np.zeros(self.counts.shape),
+                                         where=totals > 0).astype(self.dtype)
+            self._dirty_rows.clear()
+            return
+        for row in self._dirty_rows:
+            counts = self.counts[row, :self.size]
+            total = counts.sum()
+            if total > 0:
+                self._normalized[row, :self.size] = counts / total
+            else:
+                self._normalized[row, :self.size] = 0
+            if self._transposed is not None:
+                self._transposed[:self.size, row] = self._normalized[row, :self.size]
+        self._dirty_rows.clear()
+
+    def normalized(self):
+        # row-normalized transitions, i.e. m[i, j] = p(j | i). Rows with no transition are all zeros
+        self._update()
+        return self._normalized[:self.size, :self.size]
+
+    def transposed(self):
+        # m[j, i] = p(j | i), i.e. the layout of the p(x2|x1) factors of the bp graph
+        self._update()
+        if self._transposed is None:
+            self._transposed = np.ascontiguousarray(self._normalized.T)
+        return self._transposed[:self.size, :self.size]
+
+    def row(self, i):
+        # p(. | i) as a dense vector
+        return self.normalized()[i]
+
+
+class SparseTransitionMatrix:
+    """
+    Same as TransitionMatrix, for large vocabularies where each viewpoint has only a few continuations.
+    Counts are kept in one dict per row, and normalized() and transposed() are CSRMatrix,
+    rebuilt (from cached per row arrays, only dirty rows are renormalized) after each learn.
+    """
+
+    def __init__(self, dtype=np.float64):
+        self.size = 0
+        self.dtype = np.dtype(dtype)
+        # see TransitionMatrix.version
+        self.version = 0
+        # row id -> {column id: count}
+        self.rows = []
+        # time of the last update of each row, only used with decay
+        self.stamps = []
+        # normalized rows, as (columns, probabilities) arrays
+        self._row_indices = []
+        self._row_data = []
+        self._dirty_rows = set()
+        self._normalized = None
+
+    def resize(self, size):
+        while len(self.rows) < size:
+            self.rows.append({})
+            self.stamps.append(0)
+            self._row_indices.append(np.zeros(0, dtype=np.int32))
+            self._row_data.append(np.zeros(0, dtype=self.dtype))
+        if size > self.size:
+            self.version += 1
+            self.size = size
+            self._normalized = None
+
+    def _decay_rows(self, rows, decay):
+        for row_id in rows:
+            factor = decay.factor(self.stamps[row_id])
+            if factor != 1:
+                row = self.rows[row_id]
+                for to_id in row:
+                    row[to_id] *= factor
+            self.stamps[row_id] = decay.time
+
+    def add_sequence(self, id_sequence, count=1, decay=None):
+        self.version += 1
+        ids = np.asarray(id_sequence).tolist()
+        if decay is not None:
+            self._decay_rows(set(ids[:-1]), decay)
+        for from_id, to_id in zip(ids[:-1], ids[1:]):
+            row = self.rows[from_id]
+            row[to_id] = row.get(to_id, 0) + count
+            self._dirty_rows.add(from_id)
+
+    def add_transitions(self, from_ids, to_ids, count=1, decay=None):
+        # counts the transitions from_ids[i] -> to_ids[i], grouped by distinct transition
+        self.version += 1
+        pairs, pair_counts = np.unique(np.stack([from_ids, to_ids]), axis=1, return_counts=True)
+        if decay is not None:
+            self._decay_rows(set(pairs[0].tolist()), decay)
+        for from_id, to_id, n in zip(pairs[0].tolist(), pairs[1].tolist(), pair_counts.tolist()):
+            row = self.rows[from_id]
+            row[to_id] = row.get(to_id, 0) + n * count
+            self._dirty_rows.add(from_id)
+
+    def remove_sequence(self, id_sequence, count=1, decay=None):
+        self.version += 1
+        ids = np.asarray(id_sequence).tolist()
+        if decay is not None:
+            self._decay_rows(set(ids[:-1]), decay)
+        for from_id, to_id in zip(ids[:-1], ids[1:]):
+            row = self.rows[from_id]
+            row[to_id] -= count
+            if row[to_id] <= 1e-9 * count:
+                del row[to_id]
+            self._dirty_rows.add(from_id)
+
+    def add(self, from_id, to_id, count=1):
+        self.version += 1
+        row = self.rows[from_id]
+        row[to_id] = row.get(to_id, 0) + count
+        self._dirty_rows.add(from_id)
+
+    def add_weighted(self, from_ids, to_ids, weights, decay=None):
+        # same as TransitionMatrix.add_weighted
+        self.version += 1
+        from_ids = np.asarray(from_ids).tolist()
+        if decay is not None:
+            self._decay_rows(set(from_ids), decay)
+        for from_id, to_id, weight in zip(from_ids, np.asarray(to_ids).tolist(), np.asarray(weights).tolist()):
+            row = self.rows[from_id]
+            row[to_id] = row.get(to_id, 0) + weight
+            if row[to_id] <= 1e-9 * abs(weight):
+                del row[to_id]
+            self._dirty_rows.add(from_id)
+
+    def transitions(self, decay=None):
+        # (from ids, to ids, current weights) of the non zero transitions
+        from_ids, to_ids, weights = [], [], []
+        for from_id, row in enumerate(self.rows):
+            factor = 1 if decay is None else decay.factor(self.stamps[from_id])
+            for to_id, count in row.items():
+                from_ids.append(from_id)
+                to_ids.append(to_id)
+                weights.append(count * factor)
+        return np.array(from_ids, dtype=np.int64), np.array(to_ids, dtype=np.int64), np.array(weights)
+
+    def get_counts(self):
+        indices = [np.array(sorted(row), dtype=np.int32) for row in self.rows]
+        data = [np.array([row[i] for i in sorted(row)], dtype=np.float64) for row in self.rows]
+        return self._csr_from_rows(indices, data, np.float64)
+
+    def _csr_from_rows(self, row_indices, row_data, dtype):
+        indptr = np.zeros(self.size + 1, dtype=np.int64)
+        np.cumsum([len(indices) for indices in row_indices], out=indptr[1:])
+        # the extra empty arrays make concatenate work for an empty matrix
+        indices = np.concatenate(row_indices + [np.zeros(0, dtype=np.int32)])
+        data = np.concatenate(row_data + [np.zeros(0, dtype=dtype)])
+        return CSRMatrix(indptr, indices, data, (self.size, self.size))
+
+    def _update(self):
+        if not self._dirty_rows and self._normalized is not None:
+            return
+        for row_id in self._dirty_rows:
+            row = self.rows[row_id]
+            # sorted columns, as in a canonical CSR matrix
+            indices = np.array(sorted(row), dtype=np.int32)
+            counts = np.array([row[i] for i in indices.tolist()], dtype=np.float64)
+            total = counts.sum()
+            self._row_indices[row_id] = indices
+            self._row_data[row_id] = (counts / total if total > 0 else counts).astype(self.dtype)
+        self._dirty_rows.clear()
+        self._normalized = self._csr_from_rows(self._row_indices, self._row_data, self.dtype)
+
+    def normalized(self):
+        self._update()
+        return self._normalized
+
+    def transposed(self):
+        # the transpose is cached in the normalized matrix
+        return self.normalized().transpose()
+
+    def row(self, i):
+        return self.normalized().row(i)
@@ -5,13 +5,23 @@ All rights reserved.
 See LICENSE file in the project root for full license information.
 """
 
-from collections import Counter
-
 import numpy as np
 import random
+from collections import OrderedDict
 from difflib import SequenceMatcher
 
-from ctor.belief_propag import PGM, LabeledArray, Messages, NoSolutionError
+from ctor.belief_propag import Messages, NoSolutionError, chain_pgm
+from ctor.chain_bp import ChainBP
+from ctor.context_cursor import ContextCursor
+from ctor.feasibility import ConstraintChecker
+from ctor.continuation_table import ContinuationTable, choose
+from ctor import memory_usage
+from ctor.realization_index import RealizationIndex, realization_key
+from ctor.recency_decay import RecencyDecay
+from ctor.sharded_contexts import ShardedContexts
+from ctor.suffix_automaton import SuffixAutomaton
+from ctor.transition_matrix import TransitionMatrix, SparseTransitionMatrix
+from ctor.vocabulary import Vocabulary
 
 
 class _Start_vp:
@@ -25,28 +35,124 @@ class _End_vp:
 
 
 class Variable_order_Markov:
-    def __init__(self, sequence_of_stuff, vp_lambda, kmax=5):
+    # sequences at least this long are sampled with messages in the log domain (see ChainBP)
+    LOG_DOMAIN_LENGTH = 1000
+    # number of constrained chains, with their backward messages, kept by constrained_chain
+    CHAIN_CACHE_SIZE = 16
+    # and their total memory (see ChainBP.nbytes): messages are L x V arrays. Larger chains are not cached
+    CHAIN_CACHE_BYTES = 64 * 1024 * 1024
+    # number of bp graphs, by length, kept by build_bp_graph
+    BP_GRAPH_CACHE_SIZE = 8
+
+    def __init__(self, sequence_of_stuff, vp_lambda, kmax=5, sparse=False, dtype=np.float64, suffix_automaton=False,
+                 decay=None, dedup_realizations=False, shards=None):
         # the input sequences of realizations
         self.viewpoint_lambda = vp_lambda
         self.start_padding = _Start_vp()
         self.end_padding = _End_vp()
+        # the maximum order used at sampling time, unless another one is given in the request
+        # with suffix_automaton, contexts of any order are indexed by a suffix automaton instead of per order dicts,
+        # and kmax can be None (unbounded)
         self.kmax = kmax
-        self.input_sequences = []
-        self.all_unique_viewpoints = []
-        self.viewpoints_realizations = {}
-        self.prefixes_to_continuations = np.empty(self.kmax, dtype=object)
-        for k in range(self.kmax):
-            self.prefixes_to_continuations[k] = {}
+        self.use_suffix_automaton = suffix_automaton
+        # sparse stores the transition matrix in CSR format, for large vocabularies (e.g. words)
+        # dtype is used for belief propagation, float32 halves the memory bandwidth
+        self.sparse = sparse
+        self.dtype = dtype
+        # with dedup_realizations, similar realizations of a viewpoint are stored once (see RealizationIndex)
+        self.dedup_realizations = dedup_realizations
+        # recency decay of the counts (see set_decay), None for no decay
+        self.decay = None
+        # maximum memory in bytes (see set_memory_budget), None for no limit
+        self.memory_budget = None
+        self.pruning_policy = "frequency"
+        # with shards, the contexts of order >= 2 are held by this number of worker processes (see ShardedContexts),
+        # for corpora whose contexts do not fit in one process
+        self.shards = None
+        if shards:
+            if suffix_automaton:
+                print("shards are not available with a suffix automaton")
+            else:
+                self.shards = ShardedContexts(shards, kmax)
+        self.clear_memory()
+        if decay is not None:
+            self.set_decay(decay)
         if sequence_of_stuff is not None:
             self.learn_sequence(sequence_of_stuff)
 
     def clear_memory(self):
         self.input_sequences = []
-        self.all_unique_viewpoints = []
-        self.viewpoints_realizations = {}
-        self.prefixes_to_continuations = np.empty(self.kmax, dtype=object)
-        for k in range(self.kmax):
+        # the views each input sequence was learned with (see augmentation), None is the identity view
+        self.input_views = []
+        # each view of an input sequence is learned as a sequence of its own: the lists below have an entry per view,
+        # in the order of input_sequences then of their views
+        # the sequences, int-coded with the vocabulary, including start and end paddings
+        self.input_id_sequences = []
+        # each view of a sequence gets a stable id, used in realization addresses, so that sequences can be removed
+        self.sequence_ids = []
+        # sequence id -> input sequence, and its view if not the identity
+        self.sequences_by_id = {}
+        self.sequence_views = {}
+        self.next_sequence_id = 0
+        # the decay time at which each sequence was learned
+        self.sequence_times = []
+        if self.decay is not None:
+            self.decay = RecencyDecay(self.decay.rate)
+        # viewpoints are represented internally by their id in the vocabulary
+        # paddings are always registered first, so they get ids 0 and 1
+        self.vocabulary = Vocabulary()
+        self.start_id = self.vocabulary.add(self.start_padding)
+        self.end_id = self.vocabulary.add(self.end_padding)
+        # first order transition counts between vp ids, maintained at each learn
+        if self.sparse:
+            self.transition_matrix = SparseTransitionMatrix(dtype=self.dtype)
+        else:
+            self.transition_matrix = TransitionMatrix(dtype=self.dtype)
+        # (matrix version, length, log domain, constraints) -> ChainBP, least recently used first
+        self.chain_cache = OrderedDict()
+        # length -> PGM of build_bp_graph, least recently used first. Graphs hold their factor data, so they are
+        # not shared with other models
+        self.bp_graphs = OrderedDict()
+        # vp id -> list of addresses
+        self.realizations = RealizationIndex(self.dedup_realizations)
+        # vp id -> number of occurrences, possibly decayed, used for the priors
+        self.viewpoint_occurrences = ContinuationTable()
+        # (viewpoints, priors, cumulative priors) except paddings, cached until the next learn
+        self._priors = None
+        # for each order k, tuple of k + 1 vp ids -> ContinuationTable of continuation vp ids
+        # with a suffix automaton or shards, only order 1 is kept in a dict
+        nb_orders = 1 if self.use_suffix_automaton or self.shards is not None else self.kmax
+        if self.shards is not None:
+            self.shards.clear()
+        self.prefixes_to_continuations = np.empty(nb_orders, dtype=object)
+        for k in range(nb_orders):
             self.prefixes_to_continuations[k] = {}
+        self.suffix_automaton = None
+        if self.use_suffix_automaton:
+            self.build_suffix_automaton()
+        # number of contexts at the last memory budget check
+        self.budget_checked_contexts = 0
+
+    def build_suffix_automaton(self):
+        # the automaton counts the same continuations as the per order dicts up to kmax (see SuffixAutomaton).
+        # With an unbounded kmax, only the end padding is skipped in contexts of order >= 2
+        self.suffix_automaton = SuffixAutomaton(1 if self.kmax is None else max(self.kmax - 1, 0))
+        # ends goes to end, as in order 1
+        self.suffix_automaton.add_sequence([self.end_id, self.end_id])
+        for id_sequence in self.input_id_sequences:
+            self.suffix_automaton.add_sequence(id_sequence)
+
+    def close(self):
+        # stops the shard processes, if any
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+
+    def context_orders(self):
+        # the number of orders of contexts counted when learning, in dicts or in shards
+        if self.shards is not None:
+            return self.kmax
+        return len(self.prefixes_to_continuations)
 
     def clear_first_N_phrases(self, n):
         if not self.input_sequences:
@@ -55,146 +161,508 @@ class Variable_order_Markov:
         if len(self.input_sequences) < n:
             print("nothing to remove, memory is less than " + str(n))
             return
-        sequences_to_learn = self.input_sequences[n:]
-        self.clear_memory()
-        for seq in sequences_to_learn:
-            self.learn_sequence(seq)
+        for _ in range(n):
+            self.unlearn_sequence(0)
 
     def clear_last_phrase(self):
         if not self.input_sequences:
             print("nothing to remove, memory is empty")
             return
-        sequences_to_learn = self.input_sequences[:-1]
-        self.clear_memory()
-        for seq in sequences_to_learn:
-            self.learn_sequence(seq)
+        self.unlearn_sequence(len(self.input_sequences) - 1)
+
+    def set_decay(self, rate):
+        """Recency-weighted forgetting: counts learned n phrases ago weigh rate ** n.
+        rate None or 1 stops the decay. Counts keep their time stamps, so the decay can be changed at any time"""
+        if rate is None:
+            rate = 1.0
+        if self.suffix_automaton is not None:
+            print("decay is not available with a suffix automaton")
+            return
+        if self.decay is None:
+            if rate < 1:
+                self.decay = RecencyDecay(rate)
+        else:
+            self.decay.rate = rate
+        self._priors = None
 
-    def learn_sequence(self, sequence_of_stuff):
+    def learn_sequence(self, sequence_of_stuff, tick=True, views=None):
+        # learns the sequence through each of the views (see augmentation), by default as is.
+        # The sequence is stored once, the views are applied on the fly
+        # with decay, each learned sequence is one time step, unless tick is False. Its views share the time step
+        if views is None:
+            views = [None]
+        if self.decay is not None and tick:
+            self.decay.tick()
         self.input_sequences.append(sequence_of_stuff)
-        self.build_vo_markov_model(sequence_of_stuff)
+        self.input_views.append(views)
+        for view in views:
+            self.add_sequence_view(sequence_of_stuff, view)
+            self.build_vo_markov_model(sequence_of_stuff, view)
+        self._priors = None
+        self.enforce_memory_budget()
+
+    def add_sequence_view(self, sequence_of_stuff, view, time=None):
+        # registers a view of an input sequence with a new sequence id, learned at time (by default now),
+        # returns the id
+        sequence_id = self.next_sequence_id
+        self.next_sequence_id += 1
+        self.sequence_ids.append(sequence_id)
+        self.sequences_by_id[sequence_id] = sequence_of_stuff
+        if view is not None:
+            self.sequence_views[sequence_id] = view
+        if time is None:
+            time = 0 if self.decay is None else self.decay.time
+        self.sequence_times.append(time)
+        return sequence_id
+
+    def view_viewpoints(self, sequence_of_stuff, view=None):
+        # the viewpoints of a sequence seen through a view
+        if view is None:
+            return [self.get_viewpoint(obj) for obj in sequence_of_stuff]
+        return [self.get_viewpoint(view(obj)) for obj in sequence_of_stuff]
+
+    def learn_sequences(self, sequences, offsets=None, views=None):
+        """Learns many sequences at once, giving the same model as learn_sequence on each of them, with the same views
+        (with decay, they are learned at the same time step). sequences is a list of sequences, or, with offsets,
+        a numpy array of all the sequences concatenated: sequence i is sequences[offsets[i]:offsets[i + 1]].
+        The contexts of all orders are counted with sliding windows over the concatenated sequences,
+        then each table is updated once per distinct (context, continuation)"""
+        values = None
+        if offsets is not None:
+            values = np.asarray(sequences)
+            offsets = np.asarray(offsets)
+            sequences = [values[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+        if len(sequences) == 0:
+            return
+        if self.decay is not None:
+            self.decay.tick()
+        if views is None:
+            views = [None]
+        # each view of each sequence, learned as a sequence of its own
+        sequence_views = [(seq, view) for seq in sequences for view in views]
+        # codes the sequences with vp ids: distinct values only are looked up for numpy arrays
+        if values is not None and self.viewpoint_lambda is None and views == [None]:
+            flat_ids = self.vocabulary.add_array(values[offsets[0]:offsets[-1]])
+        else:
+            flat_ids = self.vocabulary.add_sequence([vp for seq, view in sequence_views
+                                                     for vp in self.view_viewpoints(seq, view)])
+        self.vocabulary.add_counts([self.start_id, self.end_id], len(sequence_views))
+        # the sequences with start and end paddings, concatenated
+        padded_lengths = np.array([len(seq) + 2 for seq, _ in sequence_views])
+        starts = np.concatenate([[0], np.cumsum(padded_lengths)[:-1]])
+        ends = starts + padded_lengths - 1
+        padded = np.empty(padded_lengths.sum(), dtype=np.int32)
+        padded[starts] = self.start_id
+        padded[ends] = self.end_id
+        interior = np.ones(len(padded), dtype=bool)
+        interior[starts] = False
+        interior[ends] = False
+        padded[interior] = flat_ids
+        id_sequences = np.split(padded, starts[1:])
+        for sequence_of_stuff in sequences:
+            self.input_sequences.append(sequence_of_stuff)
+            self.input_views.append(views)
+        new_sequence_ids = []
+        for (sequence_of_stuff, view), id_sequence in zip(sequence_views, id_sequences):
+            new_sequence_ids.append(self.add_sequence_view(sequence_of_stuff, view))
+            self.input_id_sequences.append(id_sequence)
+        # transitions between consecutive ids, except from ends to the next starts
+        self.transition_matrix.resize(self.voc_size())
+        not_end = np.ones(len(padded), dtype=bool)
+        not_end[ends] = False
+        not_end = np.flatnonzero(not_end)
+        self.transition_matrix.add_transitions(padded[not_end], padded[not_end + 1], decay=self.decay)
+        vp_ids, vp_counts = np.unique(flat_ids, return_counts=True)
+        if not self.realizations.dedup:
+            # all the addresses (sequence id, index), grouped by vp id in the order of learning
+            lengths = padded_lengths - 2
+            indexes = np.arange(len(flat_ids)) - np.repeat(starts - 2 * np.arange(len(starts)), lengths)
+            addresses = np.stack([np.repeat(new_sequence_ids, lengths), indexes], axis=1)
+            order = np.argsort(flat_ids, kind="stable")
+            group_ends = np.cumsum(vp_counts).tolist()
+            for vp_id, group_start, group_end in zip(vp_ids.tolist(), [0] + group_ends[:-1], group_ends):
+                self.realizations.extend(vp_id, addresses[order[group_start:group_end]])
+            for j in np.flatnonzero((indexes == 1) | (indexes == np.repeat(lengths, lengths) - 2)).tolist():
+                address = tuple(addresses[j].tolist())
+                self.realizations.add_boundary(int(flat_ids[j]), *address, self.is_starting_address(address),
+                                               self.is_ending_address(address))
+        else:
+            for sequence_index, id_sequence in zip(new_sequence_ids, id_sequences):
+                for i, vp_id in enumerate(id_sequence[1:-1].tolist()):
+                    self.add_viewpoint_realization(i, sequence_index, vp_id)
+        for vp_id, count in zip(vp_ids.tolist(), vp_counts.tolist()):
+            self.viewpoint_occurrences.add(vp_id, count, self.decay)
+        # position of each id in its padded sequence, and the length of the sequence
+        positions = np.arange(len(padded)) - np.repeat(starts, padded_lengths)
+        sizes = np.repeat(padded_lengths, padded_lengths)
+        # each window of k + 2 ids gets a dense id, computed from the id of the window of k + 1 ids at the same position
+        # and its last id, so that windows are compared as integers
+        window_ids = padded.astype(np.int64)
+        for k in range(self.context_orders()):
+            width = k + 2
+            if width > len(padded):
+                break
+            keys = window_ids[:len(padded) - width + 1] * self.voc_size() + padded[width - 1:]
+            _, window_ids = np.unique(keys, return_inverse=True)
+            # windows of a context of k + 1 ids followed by its continuation at i, for i in range(k + 1, len(ids) - k)
+            # as in build_vo_markov_model
+            window_starts = np.flatnonzero(positions[:len(window_ids)] <= sizes[:len(window_ids)] - 2 * k - 2)
+            if len(window_starts) == 0:
+                continue
+            _, first, counts = np.unique(window_ids[window_starts], return_index=True, return_counts=True)
+            # in the order of first occurrence, as when learning the sequences one by one
+            order = np.argsort(first)
+            rows = np.lib.stride_tricks.sliding_window_view(padded, width)[window_starts[first[order]]]
+            if k >= len(self.prefixes_to_continuations):
+                # in one batch per shard
+                self.shards.add([(k, tuple(row[:-1]), row[-1], count)
+                                 for row, count in zip(rows.tolist(), counts[order].tolist())], self.decay)
+                continue
+            prefixes_to_cont_k = self.prefixes_to_continuations[k]
+            for row, count in zip(rows.tolist(), counts[order].tolist()):
+                current_ctx = tuple(row[:-1])
+                table = prefixes_to_cont_k.get(current_ctx)
+                if table is None:
+                    table = prefixes_to_cont_k[current_ctx] = ContinuationTable()
+                table.add(row[-1], count, self.decay)
+        self.add_end_continuation()
+        if self.suffix_automaton is not None:
+            for id_sequence in id_sequences:
+                self.suffix_automaton.add_sequence(id_sequence)
+        self._priors = None
+        self.enforce_memory_budget()
+
+    def unlearn_sequence(self, index):
+        """Removes the index-th learned sequence from the model, with all its views, in O(sequence length) per view
+        i.e. subtracts its contexts, transitions, realizations and vocabulary references"""
+        self.input_sequences.pop(index)
+        views = self.input_views.pop(index)
+        # the views of the sequence are learned one after the other
+        position = sum(len(previous_views) for previous_views in self.input_views[:index])
+        for _ in views:
+            self.unlearn_sequence_view(position)
+        if self.suffix_automaton is not None:
+            # a suffix automaton cannot forget a sequence: it is rebuilt from the remaining int-coded sequences
+            self.build_suffix_automaton()
+
+    def unlearn_sequence_view(self, position):
+        # removes the sequence at position in input_id_sequences, i.e. a view of an input sequence
+        ids, learn_time = self.remove_sequence_view(position)
+        self._priors = None
+        count = 1 if self.decay is None else self.decay.factor(learn_time)
+        # the same loops as in build_vo_markov_model, decrementing
+        for k in range(len(self.prefixes_to_continuations)):
+            prefixes_to_cont_k = self.prefixes_to_continuations[k]
+            for i in range(k + 1, len(ids) - k):
+                current_ctx = tuple(ids[i - k - 1: i])
+                table = prefixes_to_cont_k.get(current_ctx)
+                if table is None:
+                    # pruned context
+                    continue
+                table.remove(ids[i], count, self.decay)
+                if table.distinct == 0:
+                    del prefixes_to_cont_k[current_ctx]
+        if self.shards is not None:
+            self.shards.remove(self.sharded_contexts(ids, count), self.decay)
+        self.transition_matrix.remove_sequence(ids, count, self.decay)
+        for vp_id in ids[1:-1]:
+            self.viewpoint_occurrences.remove(vp_id, count, self.decay)
+        self.release_viewpoints(ids)
+
+    def remove_sequence_view(self, position):
+        # removes the sequence at position and its realizations, but not its counts.
+        # Returns its vp ids and the time it was learned at
+        ids = self.input_id_sequences.pop(position).tolist()
+        sequence_id = self.sequence_ids.pop(position)
+        self.remove_realizations(sequence_id, ids)
+        del self.sequences_by_id[sequence_id]
+        self.sequence_views.pop(sequence_id, None)
+        return ids, self.sequence_times.pop(position)
+
+    def release_viewpoints(self, ids):
+        # uncounts the vp ids of a removed sequence in the vocabulary
+        for vp_id in self.vocabulary.remove_sequence(ids):
+            if vp_id != self.start_id and vp_id != self.end_id:
+                # its id will be reused by the next new viewpoint
+                self.vocabulary.free(vp_id)
+
+    def merge(self, other):
+        """Adds the model of other to this one, as if its sequences had been learned after ours: contexts, transitions,
+        vocabulary and realizations are merged in O(size of the model of other), without relearning its sequences,
+        e.g. to build a large model from models learned separately on shards of a corpus.
+        Input sequences are shared with other, not copied. Both models must have the same orders, context index and
+        viewpoint function. With decay, the counts of other are merged with their current weights,
+        and its sequences keep their age (the decay rates should be the same)"""
+        if not self.check_compatible(other):
+            return
+        # vp ids of other -> ours, freed ids of other are not used
+        vp_ids = [self.start_id, self.end_id] + [-1] * (other.voc_size() - 2)
+        for vp_id in other.ids_except_paddings():
+            vp_ids[vp_id] = self.vocabulary.add(other.vocabulary.viewpoint(vp_id))
+        id_mapping = np.array(vp_ids, dtype=np.int32)
+        # the sequences, with their views, and their learning times relative to the current time
+        sequence_ids = {}
+        new_id_sequences = []
+        position = 0
+        for sequence_of_stuff, views in zip(other.input_sequences, other.input_views):
+            self.input_sequences.append(sequence_of_stuff)
+            self.input_views.append(views)
+            for view in views:
+                time = None
+                if self.decay is not None and other.decay is not None:
+                    time = self.decay.time - (other.decay.time - other.sequence_times[position])
+                other_id = other.sequence_ids[position]
+                sequence_ids[other_id] = self.add_sequence_view(sequence_of_stuff, view, time)
+                id_sequence = id_mapping[other.input_id_sequences[position]]
+                self.input_id_sequences.append(id_sequence)
+                new_id_sequences.append(id_sequence)
+                position += 1
+        if not new_id_sequences:
+            return
+        self.vocabulary.add_counts(np.concatenate(new_id_sequences))
+        # transitions, except the end to end transition of add_end_continuation
+        from_ids, to_ids, weights = other.transition_matrix.transitions(other.decay)
+        kept = from_ids != other.end_id
+        self.transition_matrix.resize(self.voc_size())
+        self.transition_matrix.add_weighted(id_mapping[from_ids[kept]], id_mapping[to_ids[kept]], weights[kept],
+                                            self.decay)
+        self.add_tables(other, vp_ids, 1)
+        if self.realizations.dedup == other.realizations.dedup:
+            self.realizations.merge(other.realizations, vp_ids, sequence_ids)
+        else:
+            # the realizations of other are not comparable with ours, they are added one by one
+            for new_id, id_sequence in zip(sequence_ids.values(), new_id_sequences):
+                for i, vp_id in enumerate(id_sequence[1:-1].tolist()):
+                    self.add_viewpoint_realization(i, new_id, vp_id)
+        self.add_end_continuation()
+        if self.suffix_automaton is not None:
+            for id_sequence in new_id_sequences:
+                self.suffix_automaton.add_sequence(id_sequence)
+        self._priors = None
+        self.enforce_memory_budget()
+
+    def subtract(self, other):
+        """Removes the model of other from this one, e.g. after merge(other): contexts and transitions are decremented
+        in O(size of the model of other). The input sequences of other must be input sequences of this model
+        (the same objects, as shared by merge), they are removed with their realizations"""
+        if not self.check_compatible(other):
+            return
+        indexes = {id(sequence_of_stuff): index for index, sequence_of_stuff in enumerate(self.input_sequences)}
+        removed = [indexes.get(id(sequence_of_stuff)) for sequence_of_stuff in other.input_sequences]
+        if None in removed:
+            print("cannot subtract a model whose sequences were not learned")
+            return
+        vp_ids = [self.start_id, self.end_id] + [-1] * (other.voc_size() - 2)
+        for vp_id in other.ids_except_paddings():
+            vp_ids[vp_id] = self.index_of_vp(other.vocabulary.viewpoint(vp_id))
+        id_mapping = np.array(vp_ids, dtype=np.int32)
+        # positions of the views of each sequence, removed from the last one so that positions stay valid
+        starts = np.cumsum([0] + [len(views) for views in self.input_views]).tolist()
+        # with decay, the counts of other have decayed here since they were merged: the ratio of the weights
+        # of a sequence here and in other
+        scale = 1
+        if self.decay is not None and removed:
+            scale = self.decay.factor(self.sequence_times[starts[removed[0]]])
+            if other.decay is not None:
+                scale /= other.decay.factor(other.sequence_times[0])
+        from_ids, to_ids, weights = other.transition_matrix.transitions(other.decay)
+        kept = from_ids != other.end_id
+        self.transition_matrix.add_weighted(id_mapping[from_ids[kept]], id_mapping[to_ids[kept]],
+                                            -scale * weights[kept], self.decay)
+        self.add_tables(other, vp_ids, -scale)
+        for index in sorted(removed, reverse=True):
+            self.input_sequences.pop(index)
+            self.input_views.pop(index)
+            for position in range(starts[index + 1] - 1, starts[index] - 1, -1):
+                ids, _ = self.remove_sequence_view(position)
+                self.release_viewpoints(ids)
+        if self.suffix_automaton is not None:
+            self.build_suffix_automaton()
+        self._priors = None
+
+    def check_compatible(self, other):
+        if self.shards is not None or other.shards is not None:
+            print("models with shards cannot be combined")
+            return False
+        if len(self.prefixes_to_continuations) != len(other.prefixes_to_continuations) or (
+                self.use_suffix_automaton != other.use_suffix_automaton):
+            print("models with different orders or context indexes cannot be combined")
+            return False
+        return True
+
+    def add_tables(self, other, vp_ids, scale):
+        # adds the current weights of the context tables and occurrences of other, whose vp ids are mapped to ours
+        # by vp_ids, times scale: a negative scale subtracts
+        self.add_table(self.viewpoint_occurrences, other.viewpoint_occurrences, other.decay, vp_ids, scale)
+        end_tuple = (other.end_id,)
+        for k in range(len(other.prefixes_to_continuations)):
+            prefixes_to_cont_k = self.prefixes_to_continuations[k]
+            for context, other_table in other.prefixes_to_continuations[k].items():
+                if context == end_tuple:
+                    # see add_end_continuation
+                    continue
+                current_ctx = tuple(vp_ids[vp_id] for vp_id in context)
+                table = prefixes_to_cont_k.get(current_ctx)
+                if table is None:
+                    if scale < 0:
+                        # pruned context
+                        continue
+                    table = prefixes_to_cont_k[current_ctx] = ContinuationTable()
+                self.add_table(table, other_table, other.decay, vp_ids, scale)
+                if table.distinct == 0:
+                    del prefixes_to_cont_k[current_ctx]
+
+    def add_table(self, table, other_table, other_decay, vp_ids, scale):
+        for vp_id in other_table.ids():
+            weight = other_table.weight(vp_id, other_decay) * scale
+            if weight > 0:
+                table.add(vp_ids[vp_id], weight, self.decay)
+            else:
+                table.remove(vp_ids[vp_id], -weight, self.decay)
+
+    def remove_realizations(self, sequence_id, ids):
+        # removes the realizations of a sequence, which must still be in sequences_by_id.
+        # With dedup, the removed realizations that had similar ones are replaced by one of them (see RealizationIndex)
+        realizations = {vp_id: [] for vp_id in ids[1:-1]}
+        if self.realizations.dedup:
+            for i, vp_id in enumerate(ids[1:-1]):
+                address = (sequence_id, i)
+                if not self.is_starting_address(address) and not self.is_ending_address(address):
+                    realizations[vp_id].append((address, realization_key(self.get_input_object(address))))
+        for vp_id, vp_realizations in realizations.items():
+            self.realizations.remove(vp_id, sequence_id, vp_realizations)
 
     def get_input_object(self, obj_address):
-        # note_address is a tuple (melody index, index in melody)
-        return self.input_sequences[obj_address[0]][obj_address[1]]
+        # note_address is a tuple (sequence id, index in melody)
+        # the object is seen through the view of the sequence, if any, so it may be a new object
+        obj = self.sequences_by_id[obj_address[0]][obj_address[1]]
+        view = self.sequence_views.get(obj_address[0])
+        return obj if view is None else view(obj)
 
     @staticmethod
     def is_starting_address(note_address):
         return note_address[1] == 1
 
     def is_ending_address(self, note_address):
-        return note_address[1] == len(self.input_sequences[note_address[0]]) - 2
+        return note_address[1] == len(self.sequences_by_id[note_address[0]]) - 2
 
     def is_end_padding(self, vp):
         return vp == self.end_padding
 
     def voc_size(self):
         # the number of unique viewpoints, including Start and End viewpoints
-        return len(self.all_unique_viewpoints)
+        return len(self.vocabulary)
+
+    @property
+    def all_unique_viewpoints(self):
+        return self.vocabulary.id_to_vp
+
+    def random_initial_id(self):
+        # returns a random initial vp id, which are continuations of start paddings
+        return self.prefixes_to_continuations[0][(self.start_id,)].sample(decay=self.decay)
 
     def random_initial_vp(self):
-        # returns a random initial vp, which are continuations of start paddings
-        all_initial_vps = self.prefixes_to_continuations[0][tuple([self.start_padding])]
-        return random.choice(all_initial_vps)
+        return self.vocabulary.viewpoint(self.random_initial_id())
 
     def random_vp_with_probs(self, probs):
         idx = np.random.choice(len(probs), p=probs)
-        return self.get_all_unique_viewpoints()[idx]
+        return self.vocabulary.viewpoint(idx)
 
     def get_all_unique_viewpoints(self):
         return self.all_unique_viewpoints
 
+    def ids_except_paddings(self):
+        # paddings have ids 0 and 1. Freed ids (see unlearn_sequence) are skipped
+        return [vp_id for vp_id in range(2, self.voc_size()) if not self.vocabulary.is_free(vp_id)]
+
     def get_all_unique_viewpoints_except_paddings(self):
-        vps = self.all_unique_viewpoints[:]
-        vps.remove(self.start_padding)
-        vps.remove(self.end_padding)
-        return vps
+        return self.vocabulary.decode(self.ids_except_paddings())
 
     def index_of_vp(self, vp):
-        return self.all_unique_viewpoints.index(vp)
+        return self.vocabulary.index(vp)
 
-    def build_vo_markov_model(self, real_sequence):
+    def build_vo_markov_model(self, real_sequence, view=None):
         """Builds a variable-order Markov model for max K order
         accumulates with existing model"""
         # builds the vp sequence with extra start and end padding vps
-        vp_sequence = [self.start_padding] + [self.get_viewpoint(obj) for obj in real_sequence] + [self.end_padding]
-        # adds unique viewpoints if any
-        for vp in vp_sequence:
-            if vp not in self.all_unique_viewpoints:
-                self.all_unique_viewpoints.append(vp)
+        vp_sequence = [self.start_padding] + self.view_viewpoints(real_sequence, view) + [self.end_padding]
+        # codes the sequence with vp ids, adding unique viewpoints if any
+        id_sequence = self.vocabulary.add_sequence(vp_sequence)
+        self.input_id_sequences.append(id_sequence)
+        self.transition_matrix.resize(self.voc_size())
+        self.transition_matrix.add_sequence(id_sequence, decay=self.decay)
+        ids = id_sequence.tolist()
         # add the realization to the viewpoint's realizations
-        sequence_index = len(self.input_sequences) - 1
-        for i, vp in enumerate(vp_sequence[1:-1]):
-            if vp not in self.viewpoints_realizations:
-                self.viewpoints_realizations[vp] = []
-            self.add_viewpoint_realization(i, sequence_index, vp)
+        sequence_index = self.sequence_ids[-1]
+        for i, vp_id in enumerate(ids[1:-1]):
+            self.add_viewpoint_realization(i, sequence_index, vp_id)
+            self.viewpoint_occurrences.add(vp_id, decay=self.decay)
         # populate the prefixes_to_continuations with vp contexts to vps
-        for k in range(self.kmax):
+        for k in range(len(self.prefixes_to_continuations)):
             prefixes_to_cont_k = self.prefixes_to_continuations[k]
-            for i in range(len(vp_sequence) - k):
-                if i < k + 1:
-                    continue
-                current_ctx = tuple(vp_sequence[i - k - 1: i])
-                if current_ctx not in prefixes_to_cont_k:
-                    prefixes_to_cont_k[current_ctx] = []
-                prefixes_to_cont_k[current_ctx].append(vp_sequence[i])
-            self.prefixes_to_continuations[k] = prefixes_to_cont_k
+            for i in range(k + 1, len(ids) - k):
+                current_ctx = tuple(ids[i - k - 1: i])
+                table = prefixes_to_cont_k.get(current_ctx)
+                if table is None:
+                    table = prefixes_to_cont_k[current_ctx] = ContinuationTable()
+                table.add(ids[i], decay=self.decay)
+        if self.shards is not None:
+            self.shards.add(self.sharded_contexts(ids), self.decay)
+        self.add_end_continuation()
+        if self.suffix_automaton is not None:
+            self.suffix_automaton.add_sequence(id_sequence)
+
+    def sharded_contexts(self, ids, count=1):
+        # the (k, context, continuation, count) of the orders held by shards, for the same positions as above
+        return [(k, tuple(ids[i - k - 1: i]), ids[i], count)
+                for k in range(len(self.prefixes_to_continuations), self.kmax) for i in range(k + 1, len(ids) - k)]
+
+    def add_end_continuation(self):
         # special case for the endVp, which has no continuation, but should be in the list for consistency
-        end_tuple = tuple([self.end_padding])
+        end_tuple = (self.end_id,)
         if end_tuple not in self.prefixes_to_continuations[0]:
             # ends goes to end
-            self.prefixes_to_continuations[0][end_tuple] = [self.end_padding]
+            self.prefixes_to_continuations[0][end_tuple] = ContinuationTable({self.end_id: 1})
+            self.transition_matrix.add(self.end_id, self.end_id)
 
     # returns the priors for all viewpoints (except start and end)
     def get_priors(self):
         # there is no start and end vps in this list
-        key_counts = {key: len(continuations) for key, continuations in self.viewpoints_realizations.items()}
-        total_count = sum(key_counts.values())
-        priors = {key: count / total_count for key, count in key_counts.items()}
-        # Step 4: Convert to a sorted vector (optional)
-        sorted_keys = self.get_all_unique_viewpoints_except_paddings()
-        # Ensure consistent ordering
-        probability_vector = np.array([priors[key] for key in sorted_keys])
-        return probability_vector
+        # ordered by vp id, consistently with get_all_unique_viewpoints_except_paddings()
+        # the array is cached until the next learn and must not be modified
+        return self.cached_priors()[1]
+
+    def cached_priors(self):
+        if self._priors is None:
+            ids = self.ids_except_paddings()
+            # occurrences rather than realizations, which may be deduplicated
+            counts = np.array(self.viewpoint_occurrences.weights(ids, self.decay))
+            priors = counts / counts.sum()
+            self._priors = (self.vocabulary.decode(ids), priors, np.cumsum(priors).tolist())
+        return self._priors
 
     def sample_zero_order(self, k):
-        priors = self.get_priors()
-        return random.choices(self.get_all_unique_viewpoints_except_paddings(), weights=priors, k=k)
+        viewpoints, _, cumulative = self.cached_priors()
+        return random.choices(viewpoints, cum_weights=cumulative, k=k)
 
-    def add_viewpoint_realization_old(self, i, sequence_index, vp):
+    def add_viewpoint_realization(self, i, sequence_index, vp):
         # attention! vp sequence has extra start_vp, so i should be decreased by 1!
         new_address = tuple([sequence_index, i])
-        self.viewpoints_realizations[vp].append(new_address)
-
-    def add_viewpoint_realization_new(self, i, sequence_index, vp):
-        # adds only if different from existing ones, to avoid inflation in case of monotonous pieces
-        new_address = tuple([sequence_index, i])
-        if self.is_starting_address(new_address) or self.is_ending_address(new_address):
-            # starting address are added, cause useful at rendering time
-            self.viewpoints_realizations[vp].append(new_address)
-            return
-        new_note = self.get_input_object(new_address)
-        for real in self.viewpoints_realizations[vp]:
-            real_note = self.get_input_object(real)
-            if real_note.is_similar_realization(new_note):
-                return
-        self.viewpoints_realizations[vp].append(new_address)
-
-    add_viewpoint_realization = add_viewpoint_realization_old
+        # starting and ending addresses are indexed apart, cause useful at rendering time
+        start = self.is_starting_address(new_address)
+        end = self.is_ending_address(new_address)
+        key = None
+        if self.realizations.dedup and not start and not end:
+            # adds only if different from existing ones, to avoid inflation in case of monotonous pieces
+            key = realization_key(self.get_input_object(new_address))
+        self.realizations.add(vp, sequence_index, i, start, end, key)
 
     def get_first_order_matrix(self):
         # returns the matrix for first order Markov transitions
         # all states. This includes start and end padding states
-        keys = self.get_all_unique_viewpoints()
-        result = np.zeros((len(keys), len(keys)))
-        k0 = self.prefixes_to_continuations[0]
-        for i_vp, vp in enumerate(keys):
-            conts = k0[tuple([vp])]
-            occurrences = Counter(conts)
-            for vp2 in occurrences:
-                i_vp2 = keys.index(vp2)
-                result[i_vp, i_vp2] = occurrences[vp2]
-            result[i_vp] /= result[i_vp].sum()
-        return result
+        # the matrix is maintained incrementally and must not be modified
+        # it is a CSRMatrix if the model is sparse
+        return self.transition_matrix.normalized()
 
     def get_viewpoint(self, real_object):
         if self.viewpoint_lambda is None:
@@ -202,7 +670,7 @@ class Variable_order_Markov:
         return self.viewpoint_lambda(real_object)
 
     def get_realizations_for_vp(self, vp):
-        return self.viewpoints_realizations[vp]
+        return list(self.realizations.get(self.index_of_vp(vp)))
 
     def random_starting_note(self):
         starting_vp = (-1, 0)
@@ -217,7 +685,7 @@ class Variable_order_Markov:
         pgm = self.build_bp_graph(length)
         # sets constraints on start and end
         pgm.set_value('x1', self.index_of_vp(start_vp))
-        pgm.set_value('x' + str(length + 2), self.index_of_vp(self.end_padding))
+        pgm.set_value('x' + str(length + 2), self.end_id)
         # with BP
         try:
             vp_seq = self.sample_vp_sequence_with_bp(start_vp, length, pgm)
@@ -225,51 +693,203 @@ class Variable_order_Markov:
             return None
         return vp_seq
 
-    def sample_sequence(self, length, constraints=None):
+    def sample_sequence(self, length, constraints=None, kmax=None, log_domain=None, relax=False):
         # if length is negative, stops when reaching the provided end_viewpoint
         # if nb_sequences is positive, stops after nb_sequences occurrences of the end_vp
+        # kmax overrides the maximum order of the model for this request
+        # log_domain computes the messages in the log domain (see ChainBP), by default for long sequences
+        # with relax, the fewest constraints are dropped if they cannot be satisfied, instead of returning None
         if len(self.input_sequences) == 0:
             return None
-        pgm = self.build_bp_graph(length)
+        if log_domain is None:
+            log_domain = length >= self.LOG_DOMAIN_LENGTH
+        chain, constraints = self.feasible_chain(length, constraints, log_domain, relax)
+        if chain is None:
+            return None
         start_vp = None
-        if constraints is not None:
-            for ct_pos, ct_vp in constraints.items():
-                var_name = "x" + str(ct_pos + 1)
-                pgm.set_value(var_name, self.index_of_vp(ct_vp))
-            if 0 in constraints:
-                start_vp = constraints[0]
+        if constraints is not None and 0 in constraints:
+            start_vp = constraints[0]
         try:
-            vp_seq = self.sample_vp_sequence_with_bp(length, start_vp, pgm)
+            vp_seq = self.sample_vp_sequence_with_chain(length, start_vp, chain, kmax=kmax)
         except NoSolutionError:
             print("too many constraints?")
             return None
         return vp_seq
 
+    def sample_sequences(self, n, length, constraints=None, kmax=None, log_domain=None, relax=False):
+        """n sequences for the same request, as n calls of sample_sequence, e.g. candidates to rerank.
+        The constrained chain and its backward messages are computed once (see constrained_chain), and at each
+        step the marginals of all the sequences are computed together, as rows of one array.
+        The variable-order continuation is then chosen for each sequence, with its own cursor.
+        Sequences that reach a dead end, or all of them if the model is empty, are None"""
+        if len(self.input_sequences) == 0:
+            return [None] * n
+        if log_domain is None:
+            log_domain = length >= self.LOG_DOMAIN_LENGTH
+        chain, constraints = self.feasible_chain(length, constraints, log_domain, relax)
+        if chain is None:
+            return [None] * n
+        if constraints is not None and 0 in constraints:
+            first_ids = [self.index_of_vp(constraints[0])] * n
+        else:
+            try:
+                marginal_1 = chain.first_marginal().astype(np.float64)
+            except NoSolutionError:
+                print("too many constraints?")
+                return [None] * n
+            first_ids = np.random.choice(len(marginal_1), size=n, p=marginal_1 / marginal_1.sum()).tolist()
+        cursors = [self.cursor([vp_id], kmax) for vp_id in first_ids]
+        # indexes of the sequences without dead end
+        alive = list(range(n))
+        for i in range(length - 1):
+            if not alive:
+                break
+            marginals = chain.marginals(i + 1, [cursors[j].ids[-1] for j in alive])
+            still_alive = []
+            for j, marginal_i in zip(alive, marginals):
+                if not marginal_i.any():
+                    continue
+                # the marginals already include the markov transitions: they give the same mask as
+                # marginal_i * markov_proba in sample_vp_sequence_with_chain
+                cont = self.choose_continuation_with_bp(cursors[j].context_tables(), marginal_i)
+                if cont == -1:
+                    print("should not be here,there is always a continuation with BP")
+                    cont = self.random_initial_id()
+                cursors[j].append(cont)
+                still_alive.append(j)
+            alive = still_alive
+        alive = set(alive)
+        return [self.vocabulary.decode(cursors[j].ids) if j in alive else None for j in range(n)]
+
     # length of bp graph is length + 2: plus the start (possibly the end of an existing sequence) and plus the end viewpoint
     def build_bp_graph(self, length):
-        string = ""
-        for i in range(length):
-            string = string + "p(x" + str(i + 1) + ")"
-        for i in range(2, length + 1):
-            string = string + "p(x" + str(i) + "|x" + str(i - 1) + ")"
-        pgm = PGM.from_string(string)
-        mat = LabeledArray(np.array(self.get_first_order_matrix()).transpose(), ["x2", "x1"], )
-        # assert is_conditional_prob(mat, "x2")
-        m = self.voc_size()
-        data_dict = {}
-        for i in range(length):
-            variable_dist = np.random.uniform(1 / m, 1 / m, m)
-            # should avoid start and end values
-            variable_dist[self.index_of_vp(self.start_padding)] = 0
-            variable_dist[self.index_of_vp(self.end_padding)] = 0
-            variable_dist /= variable_dist.sum()
-            data_dict["p(x" + str(i + 1) + ")"] = LabeledArray(np.array(variable_dist), ["x" + str(i + 1)])
-            data_dict["p(x" + str(i + 2) + "|x" + str(i + 1) + ")"] = LabeledArray(
-                mat.array, ["x" + str(i + 2), "x" + str(i + 1)]
-            )
-        pgm.set_data(data_dict)
+        # the graph of a length is built once (see chain_pgm), and its data reset at each call
+        pgm = self.bp_graphs.get(length)
+        if pgm is None:
+            pgm = chain_pgm(length)
+            self.bp_graphs[length] = pgm
+            if len(self.bp_graphs) > self.BP_GRAPH_CACHE_SIZE:
+                self.bp_graphs.popitem(last=False)
+        else:
+            self.bp_graphs.move_to_end(length)
+        pgm.set_chain_data(self.chain_prior(), self.transition_matrix.transposed())
         return pgm
 
+    def chain_prior(self):
+        # the unary factor of the variables of the bp graph, uniform except for the paddings and the free ids
+        m = self.voc_size()
+        prior = np.full(m, 1 / m, dtype=self.dtype)
+        # should avoid start and end values
+        prior[self.start_id] = 0
+        prior[self.end_id] = 0
+        # ids of unlearned viewpoints, which are not realized anymore
+        prior[list(self.vocabulary.free_ids)] = 0
+        total = prior.sum()
+        if total > 0:
+            prior /= total
+        return prior
+
+    def build_chain(self, length, log_domain=False):
+        # the same graph as build_bp_graph, for exact inference on chains (see ChainBP)
+        return ChainBP(self.transition_matrix.normalized(), length, self.chain_prior(), log_domain)
+
+    def constraint_checker(self, length):
+        # unconstrained positions avoid the paddings, as in the bp graph
+        support = self.chain_prior() > 0
+        return ConstraintChecker(self.transition_matrix.normalized(), length, support)
+
+    def constraint_ids(self, length, constraints):
+        # ({position: vp id} of the valid constraints, positions of the constraints out of the sequence or
+        # with an unknown viewpoint)
+        ids = {}
+        invalid = []
+        for ct_pos, ct_vp in constraints.items():
+            vp_id = self.vocabulary.vp_to_id.get(ct_vp)
+            if vp_id is None or not 0 <= ct_pos < length:
+                invalid.append(ct_pos)
+            else:
+                ids[ct_pos] = vp_id
+        return ids, invalid
+
+    def check_constraints(self, length, constraints):
+        """The conflicts of constraints {position: viewpoint} for a sequence of length viewpoints, found on the
+        transitions only, without belief propagation (see ConstraintChecker). Empty if they can be satisfied.
+        A conflict (position, next position) means the viewpoint at next position cannot follow the one at
+        position, None standing for the start or the end of the sequence. A constraint out of the sequence,
+        or with an unknown viewpoint, is reported as (position, position)"""
+        ids, invalid = self.constraint_ids(length, constraints)
+        return [(ct_pos, ct_pos) for ct_pos in invalid] + self.constraint_checker(length).conflicts(ids)
+
+    def relax_constraints(self, length, constraints):
+        # the largest subset of the constraints that can be satisfied, None if there is no sequence of length
+        ids, _ = self.constraint_ids(length, constraints)
+        kept = self.constraint_checker(length).relaxed(ids)
+        if kept is None:
+            return None
+        return {ct_pos: constraints[ct_pos] for ct_pos in sorted(kept)}
+
+    def feasible_constraints(self, length, constraints, relax=False):
+        # the constraints if they can be satisfied, else the relaxed ones with relax, else None
+        conflicts = self.check_constraints(length, constraints)
+        if not conflicts:
+            return constraints
+        print(f"conflicting constraints: {conflicts}")
+        if not relax:
+            return None
+        relaxed = self.relax_constraints(length, constraints)
+        if relaxed is not None:
+            print(f"dropped constraints at positions {sorted(set(constraints) - set(relaxed))}")
+        return relaxed
+
+    def feasible_chain(self, length, constraints=None, log_domain=False, relax=False):
+        """(the constrained chain of a request (see constrained_chain), the constraints it was built with),
+        (None, None) if the constraints cannot be satisfied. Infeasible constraints show as a null first marginal
+        once the backward messages are computed, so only failing requests pay for the diagnostics of
+        feasible_constraints, and for the relaxation with relax. Cached chains are not checked again"""
+        if not constraints or not self.constraint_ids(length, constraints)[1]:
+            chain = self.constrained_chain(length, constraints, log_domain)
+            try:
+                chain.first_marginal()
+                return chain, constraints
+            except NoSolutionError:
+                pass
+        relaxed = self.feasible_constraints(length, constraints or {}, relax)
+        if relaxed is None:
+            return None, None
+        chain = self.constrained_chain(length, relaxed, log_domain)
+        try:
+            chain.first_marginal()
+        except NoSolutionError:
+            print("too many constraints?")
+            return None, None
+        return chain, relaxed
+
+    def constrained_chain(self, length, constraints=None, log_domain=False):
+        # the chain with the constraints set, and its backward messages once computed, cached so that repeated
+        # requests (e.g. continuations with only an end constraint) skip belief propagation.
+        # Any change of the transition matrix invalidates the cache
+        values = tuple(sorted((ct_pos, self.index_of_vp(ct_vp)) for ct_pos, ct_vp in constraints.items())) \
+            if constraints else ()
+        key = (self.transition_matrix.version, length, log_domain, values)
+        chain = self.chain_cache.get(key)
+        if chain is not None:
+            self.chain_cache.move_to_end(key)
+            return chain
+        if self.chain_cache and next(iter(self.chain_cache))[0] != key[0]:
+            self.chain_cache.clear()
+        chain = self.build_chain(length, log_domain)
+        for position, value in values:
+            chain.set_value(position, value)
+        size = chain.nbytes()
+        if size > self.CHAIN_CACHE_BYTES:
+            return chain
+        self.chain_cache[key] = chain
+        total = sum(cached.nbytes() for cached in self.chain_cache.values())
+        while len(self.chain_cache) > self.CHAIN_CACHE_SIZE or total > self.CHAIN_CACHE_BYTES:
+            _, evicted = self.chain_cache.popitem(last=False)
+            total -= evicted.nbytes()
+        return chain
+
     @staticmethod
     def is_ok(marginal):
         for x in marginal:
@@ -277,145 +897,366 @@ class Variable_order_Markov:
                 return False
         return True
 
-    def sample_vp_sequence_with_bp(self, length, start_vp, pgm):
+    def sample_vp_sequence_with_bp(self, length, start_vp, pgm, kmax=None):
         # Generates a new sequence of vps from the Markov model.
         if length < 0:
             print("impossible")
+        # the messages are kept from one step to the next, as values are fixed
+        messages = Messages()
+        # the sequence is generated as vp ids, and decoded at the end
         if start_vp is not None:
-            current_seq = [start_vp]
+            current_ids = [self.index_of_vp(start_vp)]
         else:
             try:
-                marginal_1 = Messages().marginal(pgm.variable_from_name('x1'))
-                vp = self.random_vp_with_probs(marginal_1)
-                current_seq = [vp]
-                pgm.set_value('x1', self.index_of_vp(current_seq[0]))
+                marginal_1 = messages.rooted_marginal(pgm.variable_from_index(0)).astype(np.float64)
+                # renormalized in float64, as np.random.choice is strict on the sum of probabilities
+                current_ids = [int(np.random.choice(len(marginal_1), p=marginal_1 / marginal_1.sum()))]
+                messages.set_evidence(pgm, pgm.variable_from_index(0).name, current_ids[0])
             except NoSolutionError:
                 return None
+        # the cursor follows the longest context of the generated sequence
+        cursor = self.cursor(current_ids, kmax)
         # generate the rest of the sequence
-        first_order_matrix = self.get_first_order_matrix()
         for i in range(length - 1):
-            pgm_variable = pgm.variable_from_name('x' + str(i + 2))
+            pgm_variable = pgm.variable_from_index(i + 1)
             try:
-                marginal_i = Messages().marginal(pgm_variable)
+                marginal_i = messages.rooted_marginal(pgm_variable)
                 # if not self.is_ok(marginal_i):
             except NoSolutionError:
                 return None
             # compare with the markov transition matrix
-            markov_proba = first_order_matrix[self.index_of_vp(current_seq[-1])]
+            markov_proba = self.transition_matrix.row(cursor.ids[-1])
+            product_proba = marginal_i * markov_proba
+            cont = self.choose_continuation_with_bp(cursor.context_tables(), product_proba)
+            if cont == -1:
+                print("should not be here,there is always a continuation with BP")
+                cont = self.random_initial_id()
+            cursor.append(cont)
+            # only the messages flowing away from the new value are recomputed at the next step
+            messages.set_evidence(pgm, pgm_variable.name, cont)
+        return self.vocabulary.decode(cursor.ids)
+
+    def sample_vp_sequence_with_chain(self, length, start_vp, chain, kmax=None):
+        # same as sample_vp_sequence_with_bp, with one backward pass and forward sampling on the chain
+        if length < 0:
+            print("impossible")
+        if start_vp is not None:
+            current_ids = [self.index_of_vp(start_vp)]
+        else:
+            try:
+                marginal_1 = chain.first_marginal().astype(np.float64)
+                # renormalized in float64, as np.random.choice is strict on the sum of probabilities
+                current_ids = [int(np.random.choice(len(marginal_1), p=marginal_1 / marginal_1.sum()))]
+            except NoSolutionError:
+                return None
+        cursor = self.cursor(current_ids, kmax)
+        for i in range(length - 1):
+            # conditioned on the previous viewpoint, the messages of the rest of the chain do not change
+            marginal_i = chain.marginal(i + 1, cursor.ids[-1])
+            # compare with the markov transition matrix
+            markov_proba = self.transition_matrix.row(cursor.ids[-1])
             product_proba = marginal_i * markov_proba
-            cont = self.get_continuation_with_bp(current_seq, product_proba)
+            cont = self.choose_continuation_with_bp(cursor.context_tables(), product_proba)
             if cont == -1:
                 print("should not be here,there is always a continuation with BP")
-                cont = self.random_initial_vp()
-            current_seq.append(cont)
-            pgm.set_value('x' + str(i + 2), self.index_of_vp(cont))
-        return current_seq
+                cont = self.random_initial_id()
+            cursor.append(cont)
+        return self.vocabulary.decode(cursor.ids)
 
     def sample_vp_sequence(self, start_vp, length, end_vp):
         # Generates a new sequence of vps from the Markov model.
-        current_seq = [start_vp]
+        cursor = self.cursor([self.index_of_vp(start_vp)])
         if length >= 0:
             # generate fixed length sequence
             for _ in range(length):
-                cont = self.get_continuation(current_seq)
+                cont = self.choose_continuation(cursor.context_tables())
                 if cont == -1:
                     print("restarting from scratch")
-                    cont = self.random_initial_vp()
-                current_seq.append(cont)
-            return current_seq
+                    cont = self.random_initial_id()
+                cursor.append(cont)
+            return self.vocabulary.decode(cursor.ids)
+        end_id = self.vocabulary.vp_to_id.get(end_vp)
         while True:
-            cont = self.get_continuation(current_seq)
+            cont = self.choose_continuation(cursor.context_tables())
             if cont == -1:
                 print("restarting from scratch")
-                cont = self.random_initial_vp()
-            if cont == end_vp:
+                cont = self.random_initial_id()
+            if cont == end_id:
                 print("found the end")
-                if cont != self.end_padding:
-                    current_seq.append(cont)
-                return current_seq
-            current_seq.append(cont)
+                if cont != self.end_id:
+                    cursor.append(cont)
+                return self.vocabulary.decode(cursor.ids)
+            cursor.append(cont)
 
-    def get_continuation(self, current_seq):
+    def cursor(self, id_sequence=(), kmax=None):
+        # a generation state that follows the longest context of a growing sequence of vp ids
+        return ContextCursor(self, id_sequence, kmax)
+
+    def max_order(self, kmax=None):
+        # the order used by a request: kmax if given, but never more than the orders stored in per order dicts
+        if kmax is None:
+            kmax = self.kmax
+        if self.suffix_automaton is None:
+            kmax = min(kmax, self.kmax)
+        return kmax
+
+    def last_context(self, current_seq, kmax=None):
+        # the part of current_seq that can be used as a context
+        kmax = self.max_order(kmax)
+        if kmax is None:
+            return current_seq
+        return current_seq[-kmax:]
+
+    def context_tables(self, current_ids, kmax=None):
+        # yields (k, ContinuationTable) for the suffixes of current_ids of size k <= kmax that have continuations,
+        # from the longest to the shortest
+        current_ids = self.last_context(current_ids, kmax)
+        if self.suffix_automaton is not None:
+            yield from self.suffix_automaton.context_tables(current_ids)
+            return
+        if self.shards is not None:
+            yield from self.fetch_context_tables(current_ids, len(current_ids))
+            return
+        for k in range(len(current_ids), 0, -1):
+            table = self.prefixes_to_continuations[k - 1].get(tuple(current_ids[-k:]))
+            if table is not None:
+                yield k, table
+
+    def fetch_context_tables(self, current_ids, length):
+        # with shards, the (k, ContinuationTable) of the known suffixes of current_ids of size k <= length,
+        # from the longest to the shortest, looked up in a single batch
+        sizes = range(length, 1, -1)
+        tables = self.shards.get([(k - 1, tuple(current_ids[-k:])) for k in sizes]) if length > 1 else []
+        result = [(k, table) for k, table in zip(sizes, tables) if table is not None]
+        if length > 0:
+            table = self.prefixes_to_continuations[0].get((current_ids[-1],))
+            if table is not None:
+                result.append((1, table))
+        return result
+
+    def get_continuation(self, current_seq, kmax=None):
+        cont = self.get_continuation_id(self.vocabulary.encode(self.last_context(current_seq, kmax)), kmax)
+        if cont == -1:
+            return -1
+        return self.vocabulary.viewpoint(cont)
+
+    def get_continuation_id(self, current_ids, kmax=None):
+        return self.choose_continuation(self.context_tables(current_ids, kmax))
+
+    def choose_continuation(self, tables):
+        # tables are (k, ContinuationTable) from the longest context to the shortest, see context_tables()
+        table, vp_to_skip = self.backoff_table(tables)
+        if table is None:
+            print("no continuation found")
+            return -1
+        return table.sample(exclude=vp_to_skip, decay=self.decay)
+
+    def backoff_table(self, tables):
+        # the table a continuation is drawn from, and the vp id to exclude from it if any, (None, None) if no table
         vp_to_skip = None
-        for k in range(self.kmax, 0, -1):
-            if k > len(current_seq):
-                continue
-            continuations_dict = self.prefixes_to_continuations[k - 1]
-            viewpoint_ctx = tuple(current_seq[-k:])
-            if viewpoint_ctx in continuations_dict:
-                all_cont_vps = continuations_dict[viewpoint_ctx]
-                # considers the number of different viewpoints, not the number of continuations as they are repeated
-                if len(set(all_cont_vps)) == 1 and k > 1:
-                    # proba to skip is proportional to order
-                    if random.random() > (1 / (k + 1)):
-                        # print(f"skipping continuation for {k=}")
-                        vp_to_skip = all_cont_vps[0]
-                        continue
-                    else:
-                        vp_to_skip = None
-                        # print(f"not skipping singleton continuation for {k=}")
-                if vp_to_skip is not None and k > 1:
-                    conts_to_use = [c for c in all_cont_vps if c != vp_to_skip]
+        for k, table in tables:
+            # considers the number of different viewpoints, not the number of continuations
+            if table.distinct == 1 and k > 1:
+                # proba to skip is proportional to order
+                if random.random() > (1 / (k + 1)):
+                    # print(f"skipping continuation for {k=}")
+                    vp_to_skip = table.first()
+                    continue
                 else:
-                    conts_to_use = all_cont_vps
-                next_continuation = random.choice(conts_to_use)
-                return next_continuation
-        print("no continuation found")
-        return -1
+                    vp_to_skip = None
+                    # print(f"not skipping singleton continuation for {k=}")
+            if vp_to_skip is not None and k > 1:
+                return table, vp_to_skip
+            return table, None
+        return None, None
 
-    def get_continuation_with_bp(self, current_seq, probs):
+    def continuation_probability(self, tables, vp_id, escape=False):
+        # the probability that choose_continuation draws vp_id from tables, i.e. with the singleton-skip backoff:
+        # each singleton table of order k > 1 is used with probability 1 / (k + 1), otherwise the next table is used
+        # without its continuation.
+        # With escape, a table also backs off to the next one with probability d / (n + d), for its d distinct
+        # continuations and n occurrences (PPM method C), and the last one to a uniform choice, so that
+        # continuations never seen in the longest context are not scored 0. As in PPM, the continuations of the
+        # tables backed off from are excluded from the next ones
+        probability = 0.0
+        reached = 1.0
         vp_to_skip = None
-        for k in range(self.kmax, 0, -1):
-            if k > len(current_seq):
+        excluded = set()
+        for k, table in tables:
+            if table.distinct == 1 and k > 1:
+                used = 1 / (k + 1)
+                if table.first() == vp_id:
+                    probability += reached * used
+                reached *= 1 - used
+                vp_to_skip = table.first()
                 continue
-            continuations_dict = self.prefixes_to_continuations[k - 1]
-            viewpoint_ctx = tuple(current_seq[-k:])
-            if viewpoint_ctx in continuations_dict:
-                all_cont_vps = continuations_dict[viewpoint_ctx]
-                # filters out the continuations with low probabilities
-                all_cont_vps = [vp for vp in all_cont_vps if probs[self.index_of_vp(vp)] > 0]
-                if len(all_cont_vps) == 0:
-                    # print("continuations removed by bp")
+            ids, weights, cumulative = table.arrays(self.decay)
+            removed = excluded
+            if vp_to_skip is not None and k > 1 and vp_to_skip in table:
+                if vp_id == vp_to_skip:
+                    return probability
+                removed = excluded | {vp_to_skip}
+            total = cumulative[-1]
+            distinct = len(ids)
+            for other, weight in zip(ids, weights):
+                if other in removed:
+                    total -= weight
+                    distinct -= 1
+            if distinct == 0:
+                continue
+            used = total / (total + distinct) if escape else 1.0
+            if vp_id in table:
+                return probability + reached * used * weights[ids.index(vp_id)] / total
+            if not escape:
+                return probability
+            reached *= 1 - used
+            excluded.update(ids)
+        if escape:
+            # any viewpoint but the start padding and the excluded ones
+            probability += reached / max(self.voc_size() - 1 - len(excluded), 1)
+        return probability
+
+    def log_probabilities(self, sequence_of_stuff, kmax=None, epsilon=1e-9, end=True, escape=True):
+        """The natural log of the probability of each element of a sequence, and of its end if end is True,
+        given the preceding ones (from the start padding), as drawn by choose_continuation.
+        The end is scored as the bp sampler reaches it: as in choose_continuation_with_bp, tables without the end
+        padding are skipped.
+        With escape, continuations not seen in a context back off to shorter ones (see continuation_probability):
+        otherwise a continuation missing from the longest context has probability 0, and the scores of higher
+        orders are dominated by epsilon.
+        Unknown viewpoints and continuations that cannot be drawn get probability epsilon, so that scores stay finite"""
+        ids = [self.vocabulary.vp_to_id.get(vp, -1) for vp in self.view_viewpoints(sequence_of_stuff)]
+        if end:
+            ids.append(self.end_id)
+        cursor = self.cursor([self.start_id], kmax)
+        probabilities = np.zeros(len(ids))
+        for i, vp_id in enumerate(ids):
+            if vp_id >= 0:
+                tables = cursor.context_tables()
+                if vp_id == self.end_id:
+                    tables = [(k, table) for k, table in tables if self.end_id in table]
+                probabilities[i] = self.continuation_probability(tables, vp_id, escape)
+            # an unknown viewpoint resets the context
+            cursor.append(vp_id)
+        return np.log(np.maximum(probabilities, epsilon))
+
+    def perplexity(self, sequences, kmax=None, epsilon=1e-9):
+        # exp of the average negative log probability of the elements (and ends) of held-out sequences
+        log_probabilities = np.concatenate([self.log_probabilities(seq, kmax, epsilon) for seq in sequences])
+        return float(np.exp(-log_probabilities.mean()))
+
+    def get_continuation_with_bp(self, current_seq, probs, kmax=None):
+        # probs are indexed by vp id
+        cont = self.get_continuation_id_with_bp(self.vocabulary.encode(self.last_context(current_seq, kmax)), probs,
+                                                kmax)
+        if cont == -1:
+            return -1
+        return self.vocabulary.viewpoint(cont)
+
+    def get_continuation_id_with_bp(self, current_ids, probs, kmax=None):
+        return self.choose_continuation_with_bp(self.context_tables(current_ids, kmax), probs)
+
+    def choose_continuation_with_bp(self, tables, probs):
+        vp_to_skip = None
+        for k, table in tables:
+            # filters out the continuations with low probabilities
+            ids, weights, cumulative = table.masked(probs, self.decay)
+            if len(ids) == 0:
+                # print("continuations removed by bp")
+                continue
+            # considers the number of different viewpoints, not the number of continuations
+            if len(ids) == 1 and k > 1:
+                # proba to skip is proportional to order
+                if random.random() > (1 / (k + 1)):
+                    # print(f"skipping continuation for {k=}")
+                    vp_to_skip = ids[0]
                     continue
-                # considers the number of different viewpoints, not the number of continuations as they are repeated
-                if len(set(all_cont_vps)) == 1 and k > 1:
-                    # proba to skip is proportional to order
-                    if random.random() > (1 / (k + 1)):
-                        # print(f"skipping continuation for {k=}")
-                        vp_to_skip = all_cont_vps[0]
-                        continue
-                    else:
-                        vp_to_skip = None
-                        # print(f"not skipping singleton continuation for {k=}")
-                if vp_to_skip is not None and k > 1:
-                    conts_to_use = [c for c in all_cont_vps if c != vp_to_skip]
                 else:
-                    conts_to_use = all_cont_vps
-                next_continuation = random.choice(conts_to_use)
-                # print(f"{k=}")
-                return next_continuation
+                    vp_to_skip = None
+                    # print(f"not skipping singleton continuation for {k=}")
+            if vp_to_skip is not None and k > 1:
+                return choose(ids, weights, cumulative, vp_to_skip)
+            # print(f"{k=}")
+            if len(ids) == 1:
+                return ids[0]
+            return choose(ids, weights, cumulative)
         print("no continuation found")
         return -1
 
+    def memory_report(self):
+        # estimated bytes used by each structure of the model, see memory_usage
+        report = {}
+        for k in range(len(self.prefixes_to_continuations)):
+            report[f"contexts of size {k + 1}"] = memory_usage.contexts_bytes(self.prefixes_to_continuations[k])
+        if self.shards is not None:
+            # held by the shard processes
+            for k, (_, size) in enumerate(self.shards.sizes()):
+                if k >= len(self.prefixes_to_continuations):
+                    report[f"contexts of size {k + 1}"] = size
+        report["realizations"] = memory_usage.realizations_bytes(self.realizations)
+        report["vocabulary"] = memory_usage.vocabulary_bytes(self.vocabulary)
+        report["transition matrix"] = memory_usage.transition_matrix_bytes(self.transition_matrix)
+        if self.suffix_automaton is not None:
+            report["suffix automaton"] = memory_usage.suffix_automaton_bytes(self.suffix_automaton)
+        return report
+
+    def set_memory_budget(self, max_bytes, policy="frequency"):
+        """Limits the memory of the model to about max_bytes (None for no limit), by pruning contexts of order >= 2.
+        policy is "frequency" (prunes the least frequent contexts first) or "entropy" (prunes first the contexts
+        whose continuations are best predicted by their shorter context, weighted by frequency)"""
+        if policy not in memory_usage.pruning_policies:
+            print(f"unknown pruning policy: {policy}")
+            return
+        if self.shards is not None:
+            print("memory budget is not available with shards")
+            return
+        self.memory_budget = max_bytes
+        self.pruning_policy = policy
+        self.enforce_memory_budget(force=True)
+
+    def enforce_memory_budget(self, force=False):
+        # the memory is measured only when the number of contexts has grown by 10% since the last check,
+        # and pruned to 90% of the budget, so the cost of measuring is amortized over the learned contexts
+        if self.memory_budget is None:
+            return
+        nb_contexts = sum(len(contexts) for contexts in self.prefixes_to_continuations)
+        if not force and nb_contexts <= 1.1 * self.budget_checked_contexts:
+            return
+        total = sum(self.memory_report().values())
+        if total > self.memory_budget:
+            total -= memory_usage.prune_contexts(self, total - 0.9 * self.memory_budget, self.pruning_policy)
+            if total > self.memory_budget:
+                print(f"memory budget exceeded: {total} bytes, not enough contexts to prune")
+        self.budget_checked_contexts = sum(len(contexts) for contexts in self.prefixes_to_continuations)
+
     def show_conts_structure(self):
-        for k in range(self.kmax):
+        report = self.memory_report()
+        sizes = [len(contexts) for contexts in self.prefixes_to_continuations]
+        if self.shards is not None:
+            sizes += [n for n, _ in self.shards.sizes()[len(sizes):]]
+        for k in range(len(sizes)):
             print(
-                f"size of contexts of size {k + 1}: {len(self.prefixes_to_continuations[k])}"
+                f"size of contexts of size {k + 1}: {sizes[k]}, "
+                f"{report[f'contexts of size {k + 1}']} bytes"
             )
+        if self.suffix_automaton is not None:
+            print(f"number of suffix automaton states: {len(self.suffix_automaton)}, "
+                  f"{report['suffix automaton']} bytes")
+        for name in ["realizations", "vocabulary", "transition matrix"]:
+            print(f"{name}: {report[name]} bytes")
+        print(f"total: {sum(report.values())} bytes")
         # looks at the sparsity of the matrix
         order1 = self.prefixes_to_continuations[0]
         voc_size = self.voc_size()
         min_size = voc_size
         max_size = 0
         for voc in order1.keys():
-            conts_size = len(set(order1[voc]))
+            conts_size = order1[voc].distinct
             if conts_size > max_size:
                 max_size = conts_size
             if conts_size < min_size:
                 min_size = conts_size
         print(f"voc size: {voc_size}")
         print(f"min order 1 size: {min_size}, max: {max_size}")
-        total = 0
-        for k in self.viewpoints_realizations:
-            total += len(self.viewpoints_realizations[k])
+        total = self.realizations.total()
         print(f"average nb of vp realizations: {total / voc_size}")
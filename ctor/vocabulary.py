@@ -0,0 +1,102 @@
+"""
+Copyright (c) 2025 Ynosound.
+All rights reserved.
+
+See LICENSE file in the project root for full license information.
+"""
+
+import numpy as np
+
+
+class Vocabulary:
+    """
+    Bidirectional mapping between viewpoints and integer ids.
+    Ids are allocated in order of first appearance and are dense (0..len-1), so they can be used
+    directly as row/column indexes in transition matrices and belief propagation distributions.
+    The vocabulary also counts the occurrences of each id in the learned sequences. When a viewpoint is freed
+    (no more occurrences), its id is recycled for the next new viewpoint, which keeps ids dense without
+    renumbering the contexts that are stored elsewhere.
+    Viewpoints must be hashable.
+    """
+
+    def __init__(self):
+        # viewpoint -> id
+        self.vp_to_id = {}
+        # id -> viewpoint, None for freed ids
+        self.id_to_vp = []
+        # id -> number of occurrences in learned sequences
+        self.counts = []
+        self.free_ids = set()
+
+    def __len__(self):
+        return len(self.id_to_vp)
+
+    def __contains__(self, vp):
+        return vp in self.vp_to_id
+
+    def add(self, vp):
+        # returns the id of vp, allocating a new one if vp is unknown
+        vp_id = self.vp_to_id.get(vp)
+        if vp_id is None:
+            if self.free_ids:
+                vp_id = self.free_ids.pop()
+                self.id_to_vp[vp_id] = vp
+            else:
+                vp_id = len(self.id_to_vp)
+                self.id_to_vp.append(vp)
+                self.counts.append(0)
+            self.vp_to_id[vp] = vp_id
+        return vp_id
+
+    def free(self, vp_id):
+        del self.vp_to_id[self.id_to_vp[vp_id]]
+        self.id_to_vp[vp_id] = None
+        self.free_ids.add(vp_id)
+
+    def is_free(self, vp_id):
+        return vp_id in self.free_ids
+
+    def index(self, vp):
+        return self.vp_to_id[vp]
+
+    def viewpoint(self, vp_id):
+        return self.id_to_vp[vp_id]
+
+    def encode(self, vp_sequence):
+        return [self.vp_to_id[vp] for vp in vp_sequence]
+
+    def decode(self, id_sequence):
+        return [self.id_to_vp[vp_id] for vp_id in id_sequence]
+
+    def add_sequence(self, vp_sequence):
+        # encodes a sequence, adding unknown viewpoints on the fly, and counts the occurrences
+        ids = np.fromiter((self.add(vp) for vp in vp_sequence), dtype=np.int32, count=len(vp_sequence))
+        for vp_id in ids.tolist():
+            self.counts[vp_id] += 1
+        return ids
+
+    def add_array(self, values):
+        # same as add_sequence for a numpy array of values (e.g. ints): only distinct values are looked up
+        # ids are allocated in the order of first appearance, as with add_sequence
+        uniques, first, inverse = np.unique(values, return_index=True, return_inverse=True)
+        unique_ids = np.zeros(len(uniques), dtype=np.int32)
+        for u in np.argsort(first, kind="stable").tolist():
+            unique_ids[u] = self.add(uniques[u].item())
+        ids = unique_ids[inverse.reshape(-1)]
+        self.add_counts(ids)
+        return ids
+
+    def add_counts(self, id_sequence, count=1):
+        # counts more occurrences of ids
+        present = np.bincount(id_sequence, minlength=len(self))
+        for vp_id in np.flatnonzero(present).tolist():
+            self.counts[vp_id] += int(present[vp_id]) * count
+
+    def remove_sequence(self, id_sequence):
+        # uncounts the occurrences of a sequence, returns the ids that have no more occurrences
+        unused = []
+        for vp_id in np.asarray(id_sequence).tolist():
+            self.counts[vp_id] -= 1
+            if self.counts[vp_id] == 0:
+                unused.append(vp_id)
+        return unused
@@ -14,11 +14,13 @@ if __name__ == '__main__':
     seqs = [seq.split(';')[1:-1] for seq in seqs]
     seqs = [[chord.strip() for chord in seq] for seq in seqs]
     vo = Variable_order_Markov(None, None, kmax=3)
-    for seq in seqs:
-        vo.learn_sequence(seq)
+    vo.learn_sequences(seqs)
 
     length = 8
-    for i in range(20):
-        seq = vo.sample_sequence(length, constraints={0: vo.get_viewpoint('C'), int(length/2): vo.get_viewpoint('F#7'), length - 1: vo.get_viewpoint('C')})
+    # the 20 sequences share the same constraints, so they are sampled together
+    seqs = vo.sample_sequences(20, length, constraints={0: vo.get_viewpoint('C'), int(length/2): vo.get_viewpoint('F#7'), length - 1: vo.get_viewpoint('C')})
+    for seq in seqs:
+        if seq is None:
+            continue
         result = ' '.join(seq)
         print(result)
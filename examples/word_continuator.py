@@ -13,7 +13,8 @@ if __name__ == '__main__':
         recherche = file.read().rstrip()
     char_seq = list(recherche)
     train_seq = re.findall(r"\w+|[^\w\s]", recherche, re.UNICODE)
-    vo = Variable_order_Markov(train_seq, None, 3)
+    # word vocabularies are large and sparse
+    vo = Variable_order_Markov(train_seq, None, 3, sparse=True)
     seq = vo.sample_sequence(100, constraints={0: vo.get_viewpoint('.'), 99: vo.get_viewpoint('.')})
     result = ' '.join(seq)
     # Removes spaces before punctuation
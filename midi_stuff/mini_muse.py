@@ -73,22 +73,13 @@ class Note:
             return 'overlaps'
         return 'contains'
 
+    def realization_key(self):
+        # notes with the same key are similar realizations: same pitch, velocity and timing with their neighbors
+        return (self.pitch, self.velocity, self.duration, self.preceding_end_delta, self.preceding_start_delta,
+                self.next_start_delta, self.next_end_delta)
+
     def is_similar_realization(self, note):
-        if self.pitch != note.pitch:
-            return False
-        if self.velocity != note.velocity:
-            return False
-        if self.duration != note.duration:
-            return False
-        if self.preceding_end_delta != note.preceding_end_delta:
-            return False
-        if self.preceding_start_delta != note.preceding_start_delta:
-            return False
-        if self.next_start_delta != note.next_start_delta:
-            return False
-        if self.next_end_delta != note.next_end_delta:
-            return False
-        return True
+        return self.realization_key() == note.realization_key()
 
 
 class Realized_Chord: